@@ -8,6 +8,8 @@ import requests
 import time
 import struct
 
+from trunion import key_certify
+
 DEFAULT_ISSUER = 'https://marketplace.cdn.mozilla.net/public_keys/marketplace-root-pub-key.jwk'  # noqa
 
 
@@ -61,6 +63,14 @@ def get_signing(args):
         return engine.load_private_key(args.signing_id).get_rsa()
 
 
+def new_key(args):
+    if getattr(args, 'type', 'rsa') == 'ec':
+        key = M2Crypto.EC.gen_params(M2Crypto.EC.NID_X9_62_prime256v1)
+        key.gen_key()
+        return key
+    return new_rsa_key(args)
+
+
 def new_rsa_key(args):
     if args.verbose:
         return M2Crypto.RSA.gen_key(args.bits, 0x10001)
@@ -70,6 +80,14 @@ def new_rsa_key(args):
         return M2Crypto.RSA.gen_key(args.bits, 0x10001, NoOp)
 
 
+def load_key(pem):
+    # Certified keys may be RSA or, for ES256 receipts, P-256 EC keys
+    try:
+        return M2Crypto.RSA.load_key(pem)
+    except M2Crypto.RSA.RSAError:
+        return M2Crypto.EC.load_key(pem)
+
+
 def jwk2rsa(jwk):
     # Converts a JWK exponent or modulus from base64 URL safe encoded big
     # endian byte string to an OpenSSL MPINT
@@ -108,16 +126,13 @@ def fetch_pubkey(url):
 
 
 def jwkify(pub, keyid):
-    if isinstance(pub, M2Crypto.RSA.RSA) \
-            or isinstance(pub, M2Crypto.RSA.RSA_pub):
-        pub = pub.pub()
-    elif type(pub) != tuple:
-        raise ValueError("jwkify expects an RSA object or a tuple")
-
-    return dict(jwk=[{"alg": "RSA",
-                      "kid": keyid,
-                      "exp": jwt.base64url_encode(pub[0][4:]),
-                      "mod": jwt.base64url_encode(pub[1][4:])}])
+    # key_certify.jwk knows which keys make a usable JWK, P-256 EC ones only
+    if type(pub) == tuple:
+        pub = M2Crypto.RSA.new_pub_key(pub)
+    elif not isinstance(pub, (M2Crypto.EC.EC, M2Crypto.RSA.RSA,
+                              M2Crypto.RSA.RSA_pub)):
+        raise ValueError("jwkify expects an RSA or EC object or a tuple")
+    return dict(jwk=[key_certify.jwk(pub, keyid)])
 
 
 def save_jwsplat(args, typ, value):
@@ -139,7 +154,7 @@ def save_jwsplat(args, typ, value):
 #
 
 def newkey(args):
-    key = new_rsa_key(args)
+    key = new_key(args)
 
     try:
         key.save_key(args.pem, None)
@@ -163,7 +178,7 @@ def certify(args, priv=None):
 
     if priv is None:
         try:
-            priv = M2Crypto.RSA.load_key(args.pem)
+            priv = load_key(args.pem)
         except Exception, e:
             raise ValueError("Unable to load key \"%s\": %s") % (args.pem, e)
 
@@ -205,7 +220,7 @@ def newcert(args):
 
 def pem2jwk(args):
     try:
-        priv = M2Crypto.RSA.load_key(args.pem)
+        priv = load_key(args.pem)
     except Exception, e:
         raise ValueError("Unable to load key \"%s\": %s") % (args.pem, e)
 
@@ -239,11 +254,19 @@ def run(argv):
                                  "friendly name")
     cmd_newkey.add_argument('--bits', '-b', dest='bits', default=2048,
                             help="Size of the key in bits, default 2048")
+    cmd_newkey.add_argument('--type', '-t', dest='type', default='rsa',
+                            choices=('rsa', 'ec'),
+                            help="rsa, or ec for a P-256 key to sign ES256 "
+                                 "receipts with, default rsa")
     cmd_newkey.set_defaults(func=newkey)
 
     # newcert
     cmd_newcert.add_argument('--bits', '-b', dest='bits', default=2048,
                              help="Size of the key in bits, default 2048")
+    cmd_newcert.add_argument('--type', '-t', dest='type', default='rsa',
+                             choices=('rsa', 'ec'),
+                             help="rsa, or ec for a P-256 key to sign ES256 "
+                                  "receipts with, default rsa")
     cmd_newcert.set_defaults(func=newcert)
 
     # certify
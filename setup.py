@@ -35,6 +35,9 @@ setup(name='trunion',
     main = trunion:main
     [console_scripts]
     check_keys = trunion.scripts:check_keys
+    trunion-keygen = trunion.scripts:keygen
+    trunion-verify-bulk = trunion.verify:bulk_main
+    trunion-build-revocations = trunion.verify:revocations_main
     """,
     paster_plugins=['pyramid'],
 )
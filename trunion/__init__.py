@@ -9,6 +9,8 @@
 import mozsvc.config
 
 import trunion.crypto as crypto
+import trunion.validators as validators
+import trunion.verifier as verifier
 
 
 def includeme(config):
@@ -26,6 +28,16 @@ def includeme(config):
                 chain=config.registry.settings['trunion.chainfile'],
                 engine=config.registry.settings.get('trunion.engine', None))
 
+    # Off unless a size is given
+    crypto.init_sign_cache(
+        int(config.registry.settings.get('trunion.sign_cache_size', 0)),
+        float(config.registry.settings.get('trunion.sign_cache_ttl', 30)))
+
+    # Everything /1.0/verify needs is loaded now so it never has to fetch keys
+    roots = config.registry.settings.get('trunion.trusted_roots', '')
+    verifier.init(crypto.KEYSTORE,
+                  [root.strip() for root in roots.split(',') if root.strip()])
+
     # So many fugly hacks
     if config.registry.settings.get('trunion.we_are_signing', None) == 'addons':
         crypto.init_ca(sectionify(config.registry.settings, 'addons'),
@@ -41,6 +53,14 @@ def includeme(config):
         raise Exception("No issuers provided in the config file!")
     config.registry.settings['trunion.permitted_issuers'] = iss
 
+    # Receipts are checked against these and the signing certificate on every
+    # request so the checks are put together once here
+    settings = config.registry.settings
+    rejections = validators.RejectionLog(
+        float(settings.get('trunion.rejection_log_interval', 60)),
+        float(settings.get('trunion.rejection_log_sample_rate', 0.01)))
+    validators.init(iss, crypto.KEYSTORE.cert_data, rejections)
+
 # Work around for WEIRD behaviour seen with an attempt to upgrade to mozsvc 0.8
 def sectionify(settings, section):
     section_items = {}
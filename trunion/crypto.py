@@ -8,35 +8,184 @@
 # Wrapper for crypto functions
 #
 
+from binascii import unhexlify
+import hashlib
 import jwt
 import logging
 import M2Crypto
 import json
 import re
+import struct
+import threading
+import time
+from collections import OrderedDict
 
 CERTIFICATE_RE = re.compile(r"-----BEGIN CERTIFICATE-----.+?"
                             "-----END CERTIFICATE-----", re.S)
 
+# A single compact, deterministic encoder for JWT segments.  json.dumps builds
+# a new encoder on every call when given non-default arguments so we hang on
+# to one instead.
+JWT_JSON = json.JSONEncoder(separators=(',', ':'), sort_keys=True)
+
+# JWS wants ECDSA signatures as the fixed width concatenation of r and s while
+# OpenSSL deals in MPINTs: a four byte big endian length then the number.
+ES256_SIZE = 32
+
+
+def mpint_to_bytes(mpint, size):
+    return mpint[4:].lstrip('\x00').rjust(size, '\x00')
+
+
+def bytes_to_mpint(data):
+    return struct.pack('>I', len(data) + 1) + '\x00' + data
+
+# DER SubjectPublicKeyInfo for a P-256 key, less the uncompressed point
+P256_SPKI_PREFIX = unhexlify('3059301306072a8648ce3d020106082a8648ce3d030107'
+                             '034200')
+
+# Install OpenSSL's locking callbacks so SMIME contexts can be used from
+# several threads at once.  A no-op on OpenSSL 1.1 and later.
+M2Crypto.threading.init()
+
 # Lame hack to take advantage of a not well known OpenSSL flag.  This omits
 # the S/MIME capabilities when generating a PKCS#7 signature.
 M2Crypto.SMIME.PKCS7_NOSMIMECAP = 0x200
 
 
-class KeyStore(object):
+class SigningCache(object):
+    """
+    Bounded LRU of recently signed receipts so a retried or duplicated request
+    doesn't cost another private key operation.  Entries are only good for
+    ttl seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[0] <= now:
+                self.misses += 1
+                return None
+            # Move it to the most recently used end
+            self.items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (now + self.ttl, value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.items), 'capacity': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class PublicKey(object):
+    """
+    An RS256 or ES256 verification key.  KeyStore builds on this with the
+    private half; on its own it holds keys loaded from JWKs.
+    """
+
+    def __init__(self, alg, rsa=None, ec=None):
+        self.alg = alg
+        self.rsa = rsa
+        self.ec = ec
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        if jwk.get('alg') == 'RSA':
+            exp = jwt.base64url_decode(str(jwk['exp'])).lstrip('\x00')
+            mod = jwt.base64url_decode(str(jwk['mod'])).lstrip('\x00')
+            return cls('RS256', rsa=M2Crypto.RSA.new_pub_key(
+                (bytes_to_mpint(exp), bytes_to_mpint(mod))))
+        if jwk.get('alg') == 'EC' and jwk.get('crv') == 'P-256':
+            x = jwt.base64url_decode(str(jwk['x'])).rjust(ES256_SIZE, '\x00')
+            y = jwt.base64url_decode(str(jwk['y'])).rjust(ES256_SIZE, '\x00')
+            return cls('ES256', ec=M2Crypto.EC.pub_key_from_der(
+                P256_SPKI_PREFIX + '\x04' + x + y))
+        raise ValueError("Unsupported JWK: alg %r" % jwk.get('alg'))
+
+    def jws_verify(self, signing_input, signature):
+        digest = hashlib.sha256(signing_input).digest()
+        if self.alg == 'ES256':
+            if len(signature) != 2 * ES256_SIZE:
+                return False
+            try:
+                return bool(self.ec.verify_dsa(
+                    digest, bytes_to_mpint(signature[:ES256_SIZE]),
+                    bytes_to_mpint(signature[ES256_SIZE:])))
+            except M2Crypto.EC.ECError:
+                return False
+        try:
+            return bool(self.rsa.verify(digest, signature, 'sha256'))
+        except M2Crypto.RSA.RSAError:
+            return False
+
+    def decode_jwt(self, payload):
+        return decode_jws(payload, self)
+
+
+def decode_jws(payload, key):
+    """
+    Checks the signature on a compact JWS with key, a PublicKey, and returns
+    the decoded claims.  Raises jwt.DecodeError if anything is amiss.
+    """
+    try:
+        signing_input, signature = str(payload).rsplit('.', 1)
+        header, claims = signing_input.split('.', 1)
+        header = json.loads(jwt.base64url_decode(header))
+        claims = json.loads(jwt.base64url_decode(claims))
+        signature = jwt.base64url_decode(signature)
+    except (ValueError, TypeError):
+        raise jwt.DecodeError("Malformed JWT")
+    if type(header) != dict or header.get('alg') != key.alg:
+        raise jwt.DecodeError("Algorithm not supported")
+    if not key.jws_verify(signing_input, signature):
+        raise jwt.DecodeError("Signature verification failed")
+    return claims
+
+
+class KeyStore(PublicKey):
 
     def __init__(self, key, cert, chain=None, engine=None):
         self.key_file = key
         self.cert_file = cert
         self.chain = chain
         self.cert_data = None
+        self.jwt_header = None
+        self.key_id = None
+        self.alg = None
+        self.rsa = None
+        self.ec = None
         self.engine = engine
         # I hate these hacks so much
         self.ca_cert = None
         self.factory = None
         self.addon_ca = None
+        self.sign_cache = None
 
-        # SMIME object for signing apps
-        self.smime = M2Crypto.SMIME.SMIME()
+        # App signing material.  It's loaded once and shared by the SMIME
+        # contexts, of which each thread gets its own as they are not safe to
+        # share.
+        self.smime_cert = None
+        self.smime_stack = None
+        self.smime_contexts = threading.local()
 
         # FIXME Verify that it's actually a paired set of keys
         self.set_key(self.key_file)
@@ -44,26 +193,63 @@ class KeyStore(object):
         self.load_smime_cert_chain(self.chain)
 
     def sign(self, data, hash_alg):
-        return self.key.get_rsa().sign(data, hash_alg)
+        if self.ec is not None:
+            return self.ec.sign_dsa_asn1(data)
+        return self.rsa.sign(data, hash_alg)
+
+    def jws_sign(self, signing_input):
+        digest = hashlib.sha256(signing_input).digest()
+        if self.alg == 'ES256':
+            r, s = self.ec.sign_dsa(digest)
+            return (mpint_to_bytes(r, ES256_SIZE)
+                    + mpint_to_bytes(s, ES256_SIZE))
+        return self.sign(digest, 'sha256')
+
+    def sign_receipt(self, receipt):
+        """
+        The certified receipt, certificate~JWT, for receipt.  With the signing
+        cache enabled a byte for byte identical receipt signed by the same key
+        within the cache's TTL gets the same result back without signing it
+        again.
+        """
+        payload = JWT_JSON.encode(receipt)
+        cache = self.sign_cache
+        if cache is None:
+            return self.certificate + '~' + self.encode_jwt(payload)
+
+        key = hashlib.sha256(self.key_id + '\n' + payload).digest()
+        signed = cache.get(key)
+        if signed is None:
+            signed = self.certificate + '~' + self.encode_jwt(payload)
+            cache.put(key, signed)
+        return signed
 
     def sign_app(self, data):
-        return self.xpi_sign(self.smime, data)
-
-    def sign_addon(self, identifier, data):
-        # New ephemeral for each request
-        e_key, e_req = self.factory.new(identifier)
+        return self.xpi_sign(self.smime_context(), data)
+
+    def smime_context(self):
+        smime = getattr(self.smime_contexts, 'smime', None)
+        if smime is None:
+            smime = M2Crypto.SMIME.SMIME()
+            # We short circuit the key loading functions in the SMIME class
+            smime.pkey = self.key
+            if self.smime_cert is not None:
+                smime.x509 = self.smime_cert
+            if self.smime_stack is not None:
+                smime.set_x509_stack(self.smime_stack)
+            self.smime_contexts.smime = smime
+        return smime
+
+    def sign_addon(self, identifier, data, key=None):
+        # New ephemeral for each request, unless the caller has one ready
+        e_key, e_req = self.factory.new(identifier, key)
         e_cert = self.addon_ca.certify(e_req)
 
         # Set up our SMIME object for signing
         smime = M2Crypto.SMIME.SMIME()
         smime.pkey = e_key
         smime.x509 = e_cert
-
-        # Only one thing in the certificate stack: the ephemeral CA cert.
-        # But the PCKS7 routines expect an X509_Stack type
-        stack = M2Crypto.X509.X509_Stack()
-        stack.push(self.addon_ca.certificate)
-        smime.set_x509_stack(stack)
+        smime.set_x509_stack(self.addon_ca.stack)
 
         pkcs7 = self.xpi_sign(smime, data)
         return pkcs7
@@ -74,6 +260,9 @@ class KeyStore(object):
         #
         # XPI signature verification goes belly up if there is an SMIME
         # capabilities so add the flag to prevent it being included
+        #
+        # str() hands back data itself if it's already a string so the only
+        # copy made is the one OpenSSL needs in the memory BIO.
         pkcs7 = smime.sign(M2Crypto.BIO.MemoryBuffer(str(data)),
                            M2Crypto.SMIME.PKCS7_DETACHED
                            | M2Crypto.SMIME.PKCS7_BINARY
@@ -88,12 +277,18 @@ class KeyStore(object):
         return self.key.verify_final(signature)
 
     def encode_jwt(self, payload):
-        header = dict(alg=u'RS256', typ='JWT', jku=self.cert_data['iss'])
-        return jwt.encode(payload, self, header=header,
-                          algorithm='RS256')
-
-    def decode_jwt(self, payload):
-        return jwt.decode(payload, self)
+        """
+        Produces an RS256 or ES256 compact JWS, depending on the key.  The
+        header never changes for a given certificate so its segment is built
+        once in load_jwt_cert and only the payload is serialized here.  A
+        payload that is already a string is taken to be serialized JSON and is
+        used as is.
+        """
+        if not isinstance(payload, basestring):
+            payload = JWT_JSON.encode(payload)
+        signing_input = self.jwt_header + '.' + jwt.base64url_encode(payload)
+        signature = self.jws_sign(signing_input)
+        return signing_input + '.' + jwt.base64url_encode(signature)
 
     def set_key(self, name):
         if self.engine:
@@ -115,8 +310,16 @@ class KeyStore(object):
             except M2Crypto.BIO.BIOError:
                 logging.error("Failed to load key: %s" % name, exc_info=True)
                 raise
-        # We short circuit the key loading functions in the SMIME class
-        self.smime.pkey = self.key
+        try:
+            self.rsa = self.key.get_rsa()
+            self.alg = 'RS256'
+        except (ValueError, M2Crypto.EVP.EVPError):
+            # Not RSA so it had better be a P-256 key for ES256
+            self.ec = M2Crypto.EC.load_key(name)
+            if len(self.ec) != 256:
+                raise ValueError("ES256 needs a P-256 key, \"%s\" is %d bits"
+                                 % (name, len(self.ec)))
+            self.alg = 'ES256'
 
     def load_jwt_cert(self, name):
         # FIXME  Need to verify that the pubkey in the cert does match the
@@ -129,6 +332,13 @@ class KeyStore(object):
             except jwt.DecodeError:
                 # This may raise an exception but that's ok
                 self.cert_data = json.loads(self.certificate)['jwk'][0]
+            # Names the signing key and the certificate it was issued with
+            self.key_id = hashlib.sha256(self.certificate).hexdigest()
+            if 'iss' in self.cert_data:
+                header = dict(alg=self.alg, typ='JWT',
+                              jku=self.cert_data['iss'])
+                self.jwt_header = jwt.base64url_encode(
+                    JWT_JSON.encode(header))
         except:
             logging.error("Unable to load certificate for key '%s': cannot "
                           "find '%s.crt' file in working directory"
@@ -145,11 +355,11 @@ class KeyStore(object):
                 stack = M2Crypto.X509.X509_Stack()
                 # The signing certificate should be the first in the stack.  It
                 # isn't used in the stack as it has its own place.
-                self.smime.x509 = M2Crypto.X509.load_cert_string(certs.next().group(0))
+                self.smime_cert = M2Crypto.X509.load_cert_string(certs.next().group(0))
                 for cert in certs:
                     _c = M2Crypto.X509.load_cert_string(cert.group(0))
                     stack.push(_c)
-                self.smime.set_x509_stack(stack)
+                self.smime_stack = stack
         except:
             logging.error("Unable to load SMIME certificates")
             raise
@@ -177,6 +387,10 @@ def init_ca(addons, dnbase, extensions):
                                     extensions)
 
 
+def init_sign_cache(size, ttl):
+    KEYSTORE.sign_cache = SigningCache(size, ttl) if size > 0 else None
+
+
 def sign(input_data):
     return KEYSTORE.sign(input_data, "sha256")
 
@@ -185,6 +399,16 @@ def sign_jwt(input_data):
     return KEYSTORE.encode_jwt(input_data)
 
 
+def sign_receipt(receipt):
+    return KEYSTORE.sign_receipt(receipt)
+
+
+def sign_cache_stats():
+    if KEYSTORE.sign_cache is None:
+        return None
+    return KEYSTORE.sign_cache.stats()
+
+
 def verify_jwt(input_data):
     return KEYSTORE.decode_jwt(input_data)
 
@@ -197,5 +421,15 @@ def sign_app(data):
     return KEYSTORE.sign_app(data)
 
 
-def sign_addon(identifier, data):
-    return KEYSTORE.sign_addon(identifier, data)
+def sign_addon(identifier, data, key=None):
+    return KEYSTORE.sign_addon(identifier, data, key)
+
+
+def batch_addon_key():
+    return KEYSTORE.factory.batch_key()
+
+
+def ephemeral_pool_stats():
+    if KEYSTORE.factory is None or KEYSTORE.factory.pool is None:
+        return None
+    return KEYSTORE.factory.pool.stats()
@@ -5,14 +5,169 @@
 # ***** END LICENSE BLOCK *****
 
 
+import fcntl
+import logging
+import multiprocessing
+import os
+import Queue
+import stat
+import threading
 import time
-from M2Crypto import ASN1, EVP, RSA, X509
+from M2Crypto import ASN1, EC, EVP, RSA, X509, m2
+
+from trunion.keygen import KeygenClient, generate_pem
+
+
+# Curves permitted for EC ephemeral keys, by OpenSSL and NIST names
+CURVES = {'prime256v1': EC.NID_X9_62_prime256v1,
+          'P-256': EC.NID_X9_62_prime256v1,
+          'secp384r1': EC.NID_secp384r1,
+          'P-384': EC.NID_secp384r1,
+          'secp521r1': EC.NID_secp521r1,
+          'P-521': EC.NID_secp521r1}
+
+
+class SerialAllocator(object):
+    """
+    Hands out certificate serial numbers that are unique across threads,
+    processes and nodes without any coordination between them.  From the most
+    significant bit down a serial is made up of:
+
+        milliseconds since serial_epoch | node ID | worker ID | counter
+
+    The node ID comes from the config and has no default, since copying one
+    config to every node would defeat the point.  The worker ID is either
+    configured too or claimed by locking one of the slot files in
+    serial_lock_dir for the life of the process.  Anyone who can open those
+    files can hold the slots, so the directory has to be this user's and
+    closed to everyone else.  The counter covers several certificates issued
+    in the same millisecond.
+
+    The default layout fits in 63 bits as older M2Crypto releases can't set a
+    serial any larger than a C long.
+    """
+
+    TIME_BITS = 41
+
+    def __init__(self, settings):
+        self.epoch = long(settings.get('serial_epoch', 1420070400)) * 1000
+        self.node_bits = int(settings.get('serial_node_bits', 6))
+        self.worker_bits = int(settings.get('serial_worker_bits', 10))
+        self.counter_bits = int(settings.get('serial_counter_bits', 6))
+        # RFC 5280 caps serials at 20 octets and they must be positive
+        if (self.TIME_BITS + self.node_bits + self.worker_bits
+                + self.counter_bits) > 159:
+            raise ValueError("Serial number layout is larger than 159 bits")
+
+        if settings.get('serial_node_id', None) is None:
+            raise ValueError("serial_node_id must be set, and unique to each "
+                             "node")
+        self.node_id = int(settings['serial_node_id'])
+        if not 0 <= self.node_id < 1 << self.node_bits:
+            raise ValueError("serial_node_id doesn't fit in %d bits"
+                             % self.node_bits)
+        self.configured_worker_id = settings.get('serial_worker_id', None)
+        self.lock_dir = settings.get('serial_lock_dir', None)
+        if self.configured_worker_id is not None:
+            self.configured_worker_id = int(self.configured_worker_id)
+            if not 0 <= self.configured_worker_id < 1 << self.worker_bits:
+                raise ValueError("serial_worker_id doesn't fit in %d bits"
+                                 % self.worker_bits)
+        elif not self.lock_dir:
+            raise ValueError("serial_lock_dir must be set unless "
+                             "serial_worker_id is")
+        else:
+            self.check_lock_dir()
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.slot = None
+        self.worker_id = None
+        self.last = 0
+        self.counter = 0
+
+    def check_lock_dir(self):
+        try:
+            st = os.lstat(self.lock_dir)
+        except OSError, e:
+            raise ValueError("Unable to use serial_lock_dir \"%s\": %s"
+                             % (self.lock_dir, e.strerror))
+        if not stat.S_ISDIR(st.st_mode):
+            raise ValueError("serial_lock_dir \"%s\" isn't a directory"
+                             % self.lock_dir)
+        if st.st_uid != os.getuid() or st.st_mode & 077:
+            raise ValueError("serial_lock_dir \"%s\" must be owned by this "
+                             "user and have mode 0700" % self.lock_dir)
+
+    def claim_worker_id(self):
+        if self.configured_worker_id is not None:
+            return self.configured_worker_id
+
+        # Anything derived from the PID can collide, so there's no falling
+        # back to that if the slots can't be had
+        self.check_lock_dir()
+        for slot in xrange(1 << self.worker_bits):
+            name = os.path.join(self.lock_dir, 'serial-worker-%d.lock' % slot)
+            try:
+                f = os.fdopen(os.open(name, os.O_WRONLY | os.O_CREAT
+                                      | os.O_NOFOLLOW, 0600), 'w')
+            except OSError, e:
+                raise ValueError("Unable to open serial worker slot \"%s\": "
+                                 "%s" % (name, e.strerror))
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                continue
+            # Held until the process exits
+            self.slot = f
+            return slot
+        raise ValueError("No free serial number worker slots in \"%s\""
+                         % self.lock_dir)
+
+    def allocate(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # First use, or first use since a fork in which case the
+                # parent's worker ID isn't ours to use.
+                self.pid = os.getpid()
+                self.worker_id = self.claim_worker_id()
+                self.last = 0
+                self.counter = 0
+
+            now = long(time.time() * 1000) - self.epoch
+            if now > self.last:
+                self.last = now
+                self.counter = 0
+            else:
+                # Same millisecond or the clock stepped backwards, in which
+                # case we carry on from the last time we used.
+                self.counter += 1
+                if self.counter >> self.counter_bits:
+                    if now < self.last:
+                        self.last += 1
+                    else:
+                        while now <= self.last:
+                            time.sleep(0.0005)
+                            now = long(time.time() * 1000) - self.epoch
+                        self.last = now
+                    self.counter = 0
+
+            serial = self.last
+            serial = (serial << self.node_bits) | self.node_id
+            serial = (serial << self.worker_bits) | self.worker_id
+            serial = (serial << self.counter_bits) | self.counter
+            return serial
 
 
 class EphemeralCA(object):
     """
     A convenience object that tries to encompass the majority of the functions
     associated with a certificate authority.
+
+    Everything that is the same for every certificate it issues is worked out
+    once here so that certify only has to fill in the per request bits and
+    never modifies any shared state.
     """
     def __init__(self, privkey, certificate, settings, extensions):
         # Key and certificate are loaded in trunion.crypto.KeyStore's methods
@@ -20,7 +175,16 @@ class EphemeralCA(object):
         self.key = privkey
         self.certificate = certificate
         self.settings = settings
-        self.extensions = extensions
+        # Nothing has ever been added to the issued certificates from the
+        # extensions section so it's accepted and otherwise ignored.
+        self.issuer = certificate.get_subject()
+        self.lifetime = settings['cert_validity_lifetime'] * 24 * 60 * 60
+        self.digest_alg = settings['signature_digest']
+        self.serials = SerialAllocator(settings)
+        # Only one thing in the certificate stack of a signature: this CA's
+        # certificate.  But the PCKS7 routines expect an X509_Stack type
+        self.stack = X509.X509_Stack()
+        self.stack.push(certificate)
 
     def set_validity_period(self, cert):
         now = long(time.time())
@@ -28,38 +192,98 @@ class EphemeralCA(object):
         asn1.set_time(now)
         cert.set_not_before(asn1)
         asn1 = ASN1.ASN1_UTCTIME()
-        asn1.set_time(now + self.settings['cert_validity_lifetime'] * 24 * 60 * 60)
+        asn1.set_time(now + self.lifetime)
         cert.set_not_after(asn1)
 
     def certify(self, req):
-        pubkey = req.get_pubkey()
         cert = X509.X509()
-        cert.set_pubkey(pubkey)
         cert.set_version(2)  # 2 means X509v3
-        #
-        # We are explicitly using Python's default time type * 1000 to include
-        # milliseconds.  While I don't expect to be generating these more often
-        # than once a second I've be wrong before.
-        #
-        cert.set_serial_number(int(time.time() * 1000))
+        cert.set_serial_number(self.serials.allocate())
         self.set_validity_period(cert)
 
         cert.set_subject(req.get_subject())
         cert.set_pubkey(req.get_pubkey())
-
-        cert.set_issuer(self.certificate.get_subject())
-
-        # Some massaging is necessary for extensions if provided in OpenSSL
-        # config file style
-        if ('subjectKeyIdentifier' in self.extensions
-                and self.extensions['subjectKeyIdentifier'] == 'hash'):
-            self.extensions['subjectKeyIdentifier'] = cert.get_fingerprint()
+        cert.set_issuer(self.issuer)
 
         # Aaaaaand sign
-        cert.sign(self.key, self.settings['signature_digest'])
+        cert.sign(self.key, self.digest_alg)
         return cert
 
 
+class EphemeralKeyPool(object):
+    """
+    A bounded supply of pre-generated ephemeral keys.  A background thread
+    tops the pool back up to capacity whenever it drains below the low water
+    mark so requests rarely have to wait on key generation themselves.
+
+    generate is called on that thread so it should hand the work to another
+    process, or be cheap, if it would otherwise hold the GIL.  If it fails
+    the pool tries again the next time it's woken.
+    """
+
+    def __init__(self, generate, capacity, low_water=None):
+        self.generate = generate
+        self.capacity = capacity
+        if low_water is None:
+            low_water = capacity // 2
+        self.low_water = low_water
+        self.keys = Queue.Queue(capacity)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        # Threads don't survive a fork so a pool created before a pre-forking
+        # server spawns its workers has to be restarted in each of them.
+        with self.lock:
+            if (self.thread is not None and self.thread.is_alive()
+                    and self.pid == os.getpid()):
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run,
+                                           name='ephemeral-key-pool')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            while not self.keys.full():
+                try:
+                    key = self.generate()
+                except Exception:
+                    logging.error("Failed to generate an ephemeral key for "
+                                  "the pool", exc_info=True)
+                    break
+                self.keys.put(key)
+            self.wakeup.wait()
+
+    def get(self):
+        """
+        Returns a ready key or None if the pool is empty.
+        """
+        self.start()
+        try:
+            key = self.keys.get_nowait()
+        except Queue.Empty:
+            key = None
+        with self.lock:
+            if key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.keys.qsize() < self.low_water or key is None:
+            self.wakeup.set()
+        return key
+
+    def stats(self):
+        return dict(depth=self.keys.qsize(), capacity=self.capacity,
+                    hits=self.hits, misses=self.misses)
+
+
 class EphemeralFactory(object):
     """
     Simply generating ephemeral keys and certificate requests based on settings
@@ -67,26 +291,121 @@ class EphemeralFactory(object):
     """
 
     def __init__(self, settings, dnbase):
+        self.key_type = settings.get('ephemeral_key_type', 'rsa')
+        if self.key_type not in ('rsa', 'ec'):
+            raise ValueError("Unknown ephemeral_key_type: \"%s\""
+                             % self.key_type)
         self.key_size = settings.get('ephemeral_key_size', 2048)
+        curve = settings.get('ephemeral_key_curve', 'prime256v1')
+        if curve not in CURVES:
+            raise ValueError("Unsupported ephemeral_key_curve: \"%s\""
+                             % curve)
+        self.curve = CURVES[curve]
         self.digest_alg = settings.get('signature_digest', 'sha1')
         self.dnbase = dnbase
+        # Every request gets a copy of this with its own CN tacked on
+        self.subject = X509.X509_Name()
+        for k, v in dnbase.iteritems():
+            # INI style parsers frequently convert key names to all lowercase
+            # and M2Crypto's X509_Name class doesn't like that.
+            setattr(self.subject, k.upper(), v)
+        self.keygen = None
+        # EC keys are cheap enough that there's nothing to gain from the
+        # daemon, which only deals in RSA keys.
+        if (self.key_type == 'rsa'
+                and settings.get('ephemeral_keygen_socket')):
+            self.keygen = KeygenClient(
+                settings['ephemeral_keygen_socket'], self.key_size,
+                float(settings.get('ephemeral_keygen_timeout', 0.5)))
+        self.pool = None
+        self.processes = (int(settings.get('ephemeral_keygen_processes', 0))
+                          or multiprocessing.cpu_count())
+        self.workers = None
+        self.workers_pid = None
+        self.workers_lock = threading.Lock()
+        pool_size = settings.get('ephemeral_pool_size', 0)
+        if pool_size > 0:
+            self.pool = EphemeralKeyPool(
+                self.generate_pooled_key, pool_size,
+                settings.get('ephemeral_pool_low_water', None))
+
+    def generate_key(self):
+        if self.key_type == 'ec':
+            ec = EC.gen_params(self.curve)
+            ec.gen_key()
+            # EVP.PKey has no assign_ec so do what assign_rsa does by hand
+            key = EVP.PKey()
+            if not m2.pkey_assign_ec(key.pkey, ec.ec):
+                raise ValueError("Unable to assign EC key")
+            ec._pyfree = 0
+            return key
+
+        # Prefer a key from the shared trunion-keygen daemon if there is one
+        if self.keygen is not None:
+            key = self.keygen.get()
+            if key is not None:
+                return key
 
-    def new(self, identifier):
         # New key of the correct size
         key = EVP.PKey()
         key.assign_rsa(RSA.gen_key(self.key_size, 0x10001, lambda: None))
+        return key
+
+    def generate_pooled_key(self):
+        # RSA.gen_key holds the GIL throughout so generating on the pool's
+        # thread would stall whichever request happened to be running.  RSA
+        # keys for the pool come from another process instead, the keygen
+        # daemon if there is one or else one of our worker processes.
+        if self.key_type == 'ec':
+            return self.generate_key()
+
+        if self.keygen is not None:
+            key = self.keygen.get()
+            if key is not None:
+                return key
+
+        pem = self.worker_pool().apply(generate_pem, (self.key_size,))
+        if pem is None:
+            raise ValueError("Unable to generate a %d bit key"
+                             % self.key_size)
+        return EVP.load_key_string(pem)
+
+    def batch_key(self):
+        """
+        A key for one item of a batch.  Each of the batch's threads waits here
+        with the GIL released while the worker processes generate keys, one
+        per core, so only the CA's part of the signing is left to the threads.
+        """
+        if self.pool is not None:
+            key = self.pool.get()
+            if key is not None:
+                return key
+        return self.generate_pooled_key()
+
+    def worker_pool(self):
+        with self.workers_lock:
+            # A forked child can't use its parent's workers.  Only PEM text
+            # goes to and from them so no key is ever shared with a child.
+            if self.workers is None or self.workers_pid != os.getpid():
+                self.workers = multiprocessing.Pool(self.processes)
+                self.workers_pid = os.getpid()
+            return self.workers
+
+    def new(self, identifier, key=None):
+        # Take a pre-generated key if there is one to be had
+        if key is None and self.pool is not None:
+            key = self.pool.get()
+        if key is None:
+            key = self.generate_key()
 
         # Generate the certreq
         request = X509.Request()
         request.set_pubkey(key)
 
-        # Set the request's DN
-        subject = request.get_subject()
-        for k, v in self.dnbase.iteritems():
-            # INI style parsers frequently convert key names to all lowercase
-            # and M2Crypto's X509_Name class doesn't like that.
-            setattr(subject, k.upper(), v)
-        subject.CN = identifier
+        # Set the request's DN.  The request gets its own copy of the base DN
+        # so adding the CN doesn't touch the shared one.
+        request.set_subject_name(self.subject)
+        request.get_subject().CN = identifier
 
         # Sign the request
         request.sign(key, self.digest_alg)
@@ -0,0 +1,201 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+#
+# Signing whole archives.  signing_clients' JarExtractor reads every entry
+# into memory, once to digest it and again to copy it into the signed
+# archive.  This does both a chunk at a time so the only thing that grows
+# with the archive is the manifest, a section per entry.  The manifest and
+# signature file are still signing_clients' own.
+#
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from signing_clients.apps import (Manifest, Section, Signature, ZipFile,
+                                  directory_re, file_key)
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Left over from a previous signing, these are replaced rather than signed
+SIGNATURE_FILES = frozenset(['META-INF/manifest.mf', 'META-INF/zigbert.sf',
+                             'META-INF/zigbert.rsa'])
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveTooLarge(ArchiveError):
+    pass
+
+
+def digest(data):
+    return {'md5': hashlib.md5(data).digest(),
+            'sha1': hashlib.sha1(data).digest()}
+
+
+def digest_entry(zin, info):
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    size = 0
+    entry = zin.open(info)
+    try:
+        while True:
+            chunk = entry.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            # The limits go by the sizes the archive claims so hold it to them
+            size += len(chunk)
+            if size > info.file_size:
+                raise ArchiveError("%s is larger than it claims"
+                                   % entry_name(info))
+            md5.update(chunk)
+            sha1.update(chunk)
+    finally:
+        entry.close()
+    return {'md5': md5.digest(), 'sha1': sha1.digest()}
+
+
+def entry_name(info):
+    # Names flagged as UTF-8 come out of zipfile as unicode
+    if isinstance(info.filename, unicode):
+        return info.filename.encode('utf-8')
+    return info.filename
+
+
+class StreamingJarExtractor(object):
+    """
+    Builds the manifest and signature file of an archive as signing_clients'
+    JarExtractor does, but never holds more than CHUNK_SIZE of any entry in
+    memory.  max_entries caps the size of the manifest and max_uncompressed
+    the total size of the entries, checked before any of them is read.
+    """
+
+    def __init__(self, path, outpath=None, omit_signature_sections=False,
+                 max_entries=None, max_uncompressed=None):
+        self.inpath = path
+        self.outpath = outpath
+        self.omit_sections = omit_signature_sections
+        self.sections = []
+
+        self._manifest = None
+        self._sig = None
+
+        with ZipFile(self.inpath, 'r') as zin:
+            entries = [f for f in zin.infolist()
+                       if not directory_re.search(f.filename)
+                       and f.filename not in SIGNATURE_FILES]
+            if max_entries is not None and len(entries) > max_entries:
+                raise ArchiveError("more than %d files" % max_entries)
+            if (max_uncompressed is not None
+                    and sum(f.file_size for f in entries) > max_uncompressed):
+                raise ArchiveTooLarge("more than %d bytes uncompressed"
+                                      % max_uncompressed)
+            for f in sorted(entries, key=file_key):
+                digests = digest_entry(zin, f)
+                self.sections.append(Section(entry_name(f),
+                                             algos=tuple(digests.keys()),
+                                             digests=digests))
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = Manifest(self.sections)
+        return self._manifest
+
+    @property
+    def signatures(self):
+        # zigbert.sf has a digest of each of the manifest's sections as well
+        # as of the whole manifest
+        if self._sig is None:
+            sections = []
+            for section in self.sections:
+                digests = digest(str(section))
+                sections.append(Section(section.name,
+                                        algos=tuple(digests.keys()),
+                                        digests=digests))
+            self._sig = Signature(
+                sections, digest_manifests=digest(str(self.manifest)),
+                omit_individual_sections=self.omit_sections)
+        return self._sig
+
+    @property
+    def signature(self):
+        # Only the header, without the individual sections
+        return self.signatures.header + "\n"
+
+    def make_signed(self, signature, outpath=None):
+        """
+        outpath can also be an open file, e.g. a temporary one, which is
+        written to whether or not it's empty.
+        """
+        outpath = outpath or self.outpath
+        if not outpath:
+            raise IOError("No output file specified")
+
+        if isinstance(outpath, basestring) and os.path.exists(outpath):
+            raise IOError("File already exists: %s" % outpath)
+
+        # ZipFile can only compress a chunk at a time from a file on disk so
+        # each entry is unpacked to scratch first
+        scratch = tempfile.NamedTemporaryFile(prefix='trunion-')
+        try:
+            with ZipFile(self.inpath, 'r') as zin:
+                with ZipFile(outpath, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zout:
+                    # zigbert.rsa *MUST* be the first file in the archive to
+                    # take advantage of Firefox's optimized downloading of
+                    # XPIs
+                    zout.writestr("META-INF/zigbert.rsa", signature)
+                    for f in zin.infolist():
+                        if f.filename in SIGNATURE_FILES:
+                            continue
+                        if directory_re.search(f.filename):
+                            zout.writestr(f, '')
+                            continue
+                        self.copy_entry(zin, zout, f, scratch)
+                    zout.writestr("META-INF/manifest.mf", str(self.manifest))
+                    zout.writestr("META-INF/zigbert.sf",
+                                  str(self.signatures))
+        finally:
+            scratch.close()
+
+    def copy_entry(self, zin, zout, info, scratch):
+        scratch.seek(0)
+        scratch.truncate()
+        entry = zin.open(info)
+        try:
+            shutil.copyfileobj(entry, scratch, CHUNK_SIZE)
+        finally:
+            entry.close()
+        scratch.flush()
+        # ZipFile.write takes the date and permissions from the file
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        os.utime(scratch.name, (mtime, mtime))
+        mode = (info.external_attr >> 16) & 0777
+        os.chmod(scratch.name, (mode or 0644) | 0400)
+        zout.write(scratch.name, info.filename, info.compress_type)
+
+
+def file_chunks(f, size=CHUNK_SIZE):
+    """
+    Iterates over the rest of f and closes it afterwards, so a temporary file
+    passed as a response's app_iter is removed once it's been sent.
+    """
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
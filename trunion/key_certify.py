@@ -29,7 +29,7 @@ def generate_key(bits, expiry_timestamp, price_limit, issuer=None):
 
 def certify_key(privkey, expiry_timestamp, price_limit, issuer=None,
                 issued_at=None):
-    """ Expects an M2Crypto.RSA.RSA key for privkey """
+    """ Expects an M2Crypto.RSA.RSA or M2Crypto.EC.EC key for privkey """
 
     serialized = certificate(privkey, expiry_timestamp, price_limit, issuer,
                              issued_at)
@@ -52,13 +52,9 @@ def certificate(privkey, expiry_timestamp, price_limit, issuer=None,
                 time.strftime('%F', time.gmtime(issued_at))
 
     # The certification is a JWT containing a JWK:
-    pubKey = privkey.pub()
     certificate = {
         "typ": "certified-key",
-        "jwk": [{"alg": "RSA",
-                 "kid": keyid,
-                 "mod": jwt.base64url_encode(pubKey[1][4:]),
-                 "exp": jwt.base64url_encode(pubKey[0][4:])}],
+        "jwk": [jwk(privkey, keyid)],
         "nbf": long(issued_at),
         "exp": long(expiry_timestamp),
         "iat": long(issued_at),
@@ -68,6 +64,27 @@ def certificate(privkey, expiry_timestamp, price_limit, issuer=None,
     return json.dumps(certificate)
 
 
+def jwk(key, keyid):
+    """ Public JWK for an M2Crypto.RSA.RSA or a P-256 M2Crypto.EC.EC key """
+    if isinstance(key, M2Crypto.EC.EC):
+        if len(key) != 256:
+            raise ValueError("Only P-256 EC keys are supported")
+        # The DER is a SubjectPublicKeyInfo which for P-256 ends with the
+        # uncompressed point: 0x04 followed by 32 bytes each of x and y.
+        point = key.pub().get_der()[-65:]
+        return {"alg": "EC",
+                "crv": "P-256",
+                "kid": keyid,
+                "x": jwt.base64url_encode(point[1:33]),
+                "y": jwt.base64url_encode(point[33:])}
+
+    pubKey = key.pub()
+    return {"alg": "RSA",
+            "kid": keyid,
+            "mod": jwt.base64url_encode(pubKey[1][4:]),
+            "exp": jwt.base64url_encode(pubKey[0][4:])}
+
+
 def generate_root(bits, expires, keyid):
     """For generating test root ceritifcates"""
 
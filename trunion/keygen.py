@@ -0,0 +1,214 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+#
+# A stand alone ephemeral key generation daemon.  Keys are generated on every
+# core with a process pool and handed out to the signing workers over a local
+# Unix socket so keygen capacity can be scaled separately from the web workers.
+#
+# The protocol is as dumb as it gets: the client sends the key size it wants
+# and how many seconds it will wait for it, followed by a newline, and the
+# daemon replies with a PEM encoded private key and closes the connection.  An
+# empty reply means no key could be had.
+#
+
+import ConfigParser
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import socket
+import SocketServer
+import threading
+import time
+
+from M2Crypto import EVP, RSA
+
+
+# How much sooner than the client's timeout the daemon gives up waiting on a
+# key, leaving time for the reply to get there
+REPLY_MARGIN = 0.1
+
+
+def generate_pem(key_size):
+    # Runs in the process pool.  M2Crypto objects don't pickle so the key is
+    # passed back as PEM.
+    try:
+        return RSA.gen_key(key_size, 0x10001, lambda: None).as_pem(None)
+    except Exception:
+        logging.error("Failed to generate a %d bit key" % key_size,
+                      exc_info=True)
+        return None
+
+
+class KeygenHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        start = time.time()
+        try:
+            request = self.rfile.readline(32).split()
+            key_size = int(request[0])
+            timeout = None
+            if len(request) > 1:
+                timeout = float(request[1])
+        except (IndexError, ValueError):
+            return
+        if key_size != self.server.key_size:
+            logging.warning("Client asked for a %d bit key but this daemon "
+                            "generates %d bit keys"
+                            % (key_size, self.server.key_size))
+            return
+
+        wait = self.server.wait
+        if timeout is not None:
+            wait = min(wait, timeout - REPLY_MARGIN - (time.time() - start))
+        pem = self.server.take(max(wait, 0))
+        if pem is None:
+            return
+        # Keys are scarcest when clients are timing out so one that can't be
+        # delivered goes back to the queue rather than being thrown away
+        if timeout is not None and time.time() - start >= timeout:
+            self.server.put_back(pem)
+            return
+        try:
+            # Straight to the socket, as a failed write to wfile would be
+            # tried again when the handler finishes
+            self.request.sendall(pem)
+        except socket.error:
+            self.server.put_back(pem)
+
+
+class KeygenServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, key_size, processes=None, capacity=64,
+                 wait=1.0, mode=0600):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, KeygenHandler)
+        # The socket hands out private keys so keep it locked down
+        os.chmod(path, mode)
+        self.path = path
+        self.key_size = key_size
+        self.capacity = capacity
+        self.wait = wait
+        self.keys = Queue.Queue(capacity)
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.workers = multiprocessing.Pool(processes)
+        self.fill()
+
+    def fill(self):
+        with self.lock:
+            while self.keys.qsize() + self.outstanding < self.capacity:
+                self.outstanding += 1
+                self.workers.apply_async(generate_pem, (self.key_size,),
+                                         callback=self.add)
+
+    def add(self, pem):
+        # Called from the process pool's result handling thread
+        with self.lock:
+            self.outstanding -= 1
+        if pem is not None:
+            self.keys.put(pem)
+
+    def take(self, wait=None):
+        if wait is None:
+            wait = self.wait
+        try:
+            pem = self.keys.get(timeout=wait)
+        except Queue.Empty:
+            pem = None
+        self.fill()
+        return pem
+
+    def put_back(self, pem):
+        try:
+            self.keys.put_nowait(pem)
+        except Queue.Full:
+            pass
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.workers.terminate()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class KeygenClient(object):
+    """
+    Fetches ephemeral keys from a running trunion-keygen.  Any failure to get
+    a key, including a timeout, returns None so the caller can fall back to
+    generating its own.
+    """
+
+    def __init__(self, path, key_size, timeout=0.5):
+        self.path = path
+        self.key_size = key_size
+        self.timeout = float(timeout)
+
+    def get(self):
+        chunks = []
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall('%d %s\n' % (self.key_size, self.timeout))
+            while True:
+                data = sock.recv(8192)
+                if not data:
+                    break
+                chunks.append(data)
+            pem = ''.join(chunks)
+            if not pem:
+                return None
+            return EVP.load_key_string(pem)
+        except Exception, e:
+            # Never worse than generating the key ourselves
+            logging.warning("Unable to fetch a key from trunion-keygen at "
+                            "\"%s\": %s" % (self.path, e))
+            return None
+        finally:
+            sock.close()
+
+
+def serve_from_config(path):
+    config = ConfigParser.ConfigParser()
+    config.read(path)
+
+    try:
+        socket_path = config.get('addons', 'ephemeral_keygen_socket')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        raise ValueError("ephemeral_keygen_socket is missing from the addons "
+                         "section of the config.")
+
+    def option(section, name, default, conv):
+        try:
+            return conv(config.get(section, name))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+
+    key_size = option('addons', 'ephemeral_key_size', 2048, int)
+    processes = option('keygen', 'processes', None, int)
+    capacity = option('keygen', 'capacity', 64, int)
+    wait = option('keygen', 'wait', 1.0, float)
+    mode = option('keygen', 'socket_mode', 0600, lambda v: int(v, 8))
+
+    server = KeygenServer(socket_path, key_size, processes, capacity, wait,
+                          mode)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
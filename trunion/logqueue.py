@@ -0,0 +1,152 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+#
+# Logging that stays off the request path.  Request threads only put records
+# on a bounded queue and a background thread hands them to the handlers that
+# actually write to syslog, files or stderr.  If the queue is full the record
+# is dropped and counted rather than making the request wait.
+#
+# Python 2.7 has no QueueHandler or QueueListener so these stand in for them.
+# The handler is a MemoryHandler as far as logging.config is concerned, which
+# lets the INI name the handler it feeds:
+#
+#   [handler_queue]
+#   class = trunion.logqueue.QueueHandler
+#   args = (10000,)
+#   target = syslog
+#
+# Records are formatted by the target in the background thread so anything
+# mutable passed as a log argument should not be changed afterwards.
+#
+
+import logging
+import logging.handlers
+import os
+import Queue
+import threading
+import time
+import weakref
+
+# Every QueueHandler, for /status
+QUEUES = weakref.WeakSet()
+
+
+class QueueHandler(logging.handlers.MemoryHandler):
+
+    def __init__(self, capacity=10000, target=None, report_interval=60):
+        # None of MemoryHandler's buffering is used
+        logging.Handler.__init__(self)
+        self.target = target
+        self.capacity = capacity
+        self.report_interval = report_interval
+        self.queue = Queue.Queue(capacity)
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        QUEUES.add(self)
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            # Not locked, an occasional miscount beats contention here
+            self.dropped += 1
+
+    def start(self):
+        with self.start_lock:
+            # The thread doesn't survive a fork so each process gets its own
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Forked, and the parent's queue may have been locked by one
+                # of its threads at the time.  Whatever is on it is the
+                # parent's to write anyway.
+                self.queue = Queue.Queue(self.capacity)
+                self.dropped = 0
+            self.listener = QueueListener(self)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stats(self):
+        return {'target': self.target.__class__.__name__,
+                'depth': self.queue.qsize(), 'capacity': self.capacity,
+                'dropped': self.dropped}
+
+    def flush(self):
+        # Records still on the queue are written by the listener, flushing
+        # here would only put the target's I/O back on the caller's thread
+        pass
+
+    def close(self):
+        QUEUES.discard(self)
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        if self.target is not None:
+            self.target.flush()
+        logging.Handler.close(self)
+
+
+class QueueListener(threading.Thread):
+
+    STOP = object()
+
+    def __init__(self, source):
+        threading.Thread.__init__(self, name='trunion-logqueue')
+        self.daemon = True
+        self.source = source
+        self.reported = source.dropped
+        self.last_report = time.time()
+
+    def run(self):
+        source = self.source
+        while True:
+            try:
+                record = source.queue.get(timeout=1)
+            except Queue.Empty:
+                record = None
+            if record is self.STOP:
+                break
+            if record is not None:
+                self.handle(record)
+            if time.time() - self.last_report >= source.report_interval:
+                self.report()
+        self.report()
+
+    def handle(self, record):
+        target = self.source.target
+        if target is not None and record.levelno >= target.level:
+            target.handle(record)
+
+    def report(self):
+        self.last_report = time.time()
+        dropped = self.source.dropped
+        if dropped == self.reported:
+            return
+        record = logging.LogRecord(
+            'trunion.logqueue', logging.WARNING, __file__, 0,
+            "Log queue full, dropped %d records", (dropped - self.reported,),
+            None)
+        self.reported = dropped
+        self.handle(record)
+
+    def stop(self, timeout=5):
+        # Whatever is already queued is written first
+        try:
+            self.source.queue.put(self.STOP, timeout=timeout)
+        except Queue.Full:
+            return
+        self.join(timeout)
+
+
+def stats():
+    queues = [handler.stats() for handler in list(QUEUES)
+              if handler.target is not None]
+    return queues or None
@@ -4,8 +4,10 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import logging
 import os
 import sys
+from trunion.keygen import serve_from_config
 from trunion.utils import check_keys_from_config as _check_keys
 
 
@@ -17,3 +19,14 @@ def check_keys():
         raise ValueError("'%s' doesn't exist" % sys.argv[1])
 
     _check_keys(sys.argv[1])
+
+
+def keygen():
+    if len(sys.argv) != 2:
+        raise ValueError("Usage:  %s <path to trunion INI file>" % sys.argv[0])
+
+    if not os.path.exists(sys.argv[1]):
+        raise ValueError("'%s' doesn't exist" % sys.argv[1])
+
+    logging.basicConfig(level=logging.INFO)
+    serve_from_config(sys.argv[1])
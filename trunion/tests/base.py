@@ -22,6 +22,11 @@ from M2Crypto.m2 import pkcs7_read_bio_der
 class StupidRequest(testing.DummyRequest):
     """This is a stupid subclass so I can get a json_body property"""
 
+    def __init__(self, *args, **kwargs):
+        super(StupidRequest, self).__init__(*args, **kwargs)
+        # Cornice adds this to real requests
+        self.validated = {}
+
     @property
     def json_body(self):
         return self.POST
@@ -4,25 +4,73 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
+import time
 import uuid
+import zipfile
 
+from base64 import b64encode
 from cStringIO import StringIO
 
+from M2Crypto import EC, SMIME
+from M2Crypto.BIO import MemoryBuffer
+from M2Crypto.X509 import X509_Stack, X509_Store
+
 from mozsvc.config import load_into_settings
 from mozsvc.tests.support import TestCase
 from pyramid import testing
 from pyramid.httpexceptions import HTTPBadRequest
 from signing_clients.apps import JarExtractor
+from webob.acceptparse import MIMEAccept
 
 import trunion.crypto as crypto
+import trunion.ephemeral as ephemeral
+import trunion.views as views
 
-from trunion.ephemeral import EphemeralFactory
+from trunion.ephemeral import (EphemeralFactory, EphemeralKeyPool,
+                               SerialAllocator)
+from trunion.keygen import generate_pem
 from trunion.tests.base import (StupidRequest,
                                 response_to_pkcs7,
                                 get_signature_cert_subject)
-from trunion.validators import valid_addon
-from trunion.views import sign_addon
+from trunion.validators import valid_addon, valid_addon_batch, valid_archive
+from trunion.views import sign_addon, sign_addon_batch, sign_archive
+
+
+# Shared with the processes forked by test_10_serial_numbers_unique
+SERIALS = None
+
+
+def allocate_serials(count):
+    serials = []
+
+    def allocate():
+        for i in xrange(count):
+            serials.append(SERIALS.allocate())
+
+    threads = [threading.Thread(target=allocate) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return serials
+
+
+# Where generate_pem_recording_pid leaves a file named for each process that
+# generated a key
+KEYGEN_PIDS = None
+
+
+def generate_pem_recording_pid(key_size):
+    open(os.path.join(KEYGEN_PIDS, str(os.getpid())), 'w').close()
+    # Long enough that another worker has to take the next key
+    time.sleep(0.2)
+    return generate_pem(key_size)
 
 
 class FormFile(object):
@@ -85,6 +133,8 @@ SHA1-Digest: lys436ZGYKrHY6n57Iy/EyF5FuI=
         load_into_settings(self.ini, settings)
         # FIXME Just have a separate INI file
         settings['trunion.we_are_signing'] = 'addons'
+        self.lock_dir = tempfile.mkdtemp()
+        settings['addons.serial_lock_dir'] = self.lock_dir
         self.config.add_settings(settings)
         self.config.include("trunion")
         # All of that just for this
@@ -167,13 +217,16 @@ SHA1-Digest: lys436ZGYKrHY6n57Iy/EyF5FuI=
         self.assertRaises(HTTPBadRequest, valid_addon, request)
 
     def test_04_validator_reset_file_position(self):
-        # An ugly bug during release
+        # An ugly bug during release: the upload was read a second time from
+        # where the validator left off.  Now it's only read by the validator
+        # and what it read is what gets signed.
         extracted = self._extract(True)
         post = dict(addon_id='hot_pink_bougainvillea',
                     file=FormFile('zigbert.sf', extracted.signature))
         request = StupidRequest(path="/1.0/sign_addon", post=post)
         valid_addon(request)
-        self.assertEqual(request.POST['file'].file.tell(), 0)
+        self.assertEqual(request.validated['signature'],
+                         str(extracted.signature))
 
     def test_05_sign_addons(self):
         """
@@ -195,5 +248,295 @@ SHA1-Digest: lys436ZGYKrHY6n57Iy/EyF5FuI=
                          "O=Allizom, Cni., ST=Denial, "
                          "CN=hot_pink_bougainvillea")
 
+    def test_05_sign_addons_raw(self):
+        extracted = self._extract(True)
+        request = StupidRequest(path="/1.0/sign_addon", post={},
+                                headers={'X-Addon-Id': 'raw_bougainvillea'},
+                                params=dict(filename='zigbert.sf'),
+                                content_type='application/octet-stream',
+                                body=str(extracted.signature))
+        valid_addon(request)
+        response = sign_addon(request)
+        signature = response_to_pkcs7(response['zigbert.rsa'])
+        self.assertTrue(get_signature_cert_subject(signature)
+                        .endswith("CN=raw_bougainvillea"))
+
+        request = StupidRequest(path="/1.0/sign_addon", post={},
+                                params=dict(filename='zigbert.sf'),
+                                content_type='application/octet-stream',
+                                body=str(extracted.signature))
+        self.assertRaises(HTTPBadRequest, valid_addon, request)
+
+    def test_06_ephemeral_pool(self):
+        dnbase = dict(C='US', ST='Denial', L='Calvinville',
+                      O='Allizom, Cni.', OU='Derivative Knuckles')
+        settings = dict(ephemeral_key_size=512, ephemeral_pool_size=2)
+        e = EphemeralFactory(settings, dnbase)
+        e.pool.start()
+        for i in range(100):
+            if e.pool.stats()['depth'] == 2:
+                break
+            time.sleep(0.05)
+        key, req = e.new('pooled')
+        self.assertEqual(req.get_pubkey().as_der(), key.as_der())
+        self.assertEqual(e.pool.stats()['hits'], 1)
+        self.assertEqual(e.pool.stats()['misses'], 0)
+
+    def test_07_ephemeral_pool_miss(self):
+        gate = threading.Event()
+
+        def generate():
+            gate.wait()
+            return 'key'
+
+        pool = EphemeralKeyPool(generate, 1)
+        self.assertEqual(pool.get(), None)
+        self.assertEqual(pool.stats()['misses'], 1)
+        gate.set()
+        for i in range(100):
+            if pool.stats()['depth'] == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(pool.get(), 'key')
+        self.assertEqual(pool.stats()['hits'], 1)
+
+    def test_07_ephemeral_pool_failure(self):
+        failures = [ValueError("no key for you")]
+
+        def generate():
+            if failures:
+                raise failures.pop()
+            return 'key'
+
+        pool = EphemeralKeyPool(generate, 1)
+        self.assertEqual(pool.get(), None)
+        for i in range(100):
+            if not failures:
+                break
+            time.sleep(0.05)
+        # The thread is still there and tries again once woken by a miss
+        self.assertTrue(pool.thread.is_alive())
+        pool.get()
+        for i in range(100):
+            if pool.stats()['depth'] == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(pool.get(), 'key')
+
+    def test_08_sign_addon_ec(self):
+        settings = self.config.registry.settings
+        factory = crypto.KEYSTORE.factory
+        crypto.KEYSTORE.factory = EphemeralFactory(
+            dict(self.sectionify(settings, 'addons'),
+                 ephemeral_key_type='ec'),
+            self.sectionify(settings, 'dnbase'))
+        try:
+            data = str(self._extract(True).signature)
+            pkcs7 = crypto.sign_addon('ec_bougainvillea', data)
+        finally:
+            crypto.KEYSTORE.factory = factory
+
+        signature = response_to_pkcs7(b64encode(pkcs7))
+        signer = signature.get0_signers(X509_Stack())[0]
+        # Only parses if the ephemeral key really is an EC key
+        EC.pub_key_from_der(signer.get_pubkey().as_der())
+
+        smime = SMIME.SMIME()
+        smime.set_x509_stack(X509_Stack())
+        smime.set_x509_store(X509_Store())
+        self.assertEqual(smime.verify(signature, MemoryBuffer(data),
+                                      SMIME.PKCS7_DETACHED
+                                      | SMIME.PKCS7_BINARY
+                                      | SMIME.PKCS7_NOVERIFY), data)
+
+    def test_09_signing_template_untouched(self):
+        factory = crypto.KEYSTORE.factory
+        subject = factory.subject.as_text()
+        for name in ('template-1', 'template-2'):
+            crypto.sign_addon(name, str(self._extract(True).signature))
+        self.assertEqual(factory.subject.as_text(), subject)
+        self.assertFalse('CN=' in subject)
+
+    def test_10_serial_numbers_unique(self):
+        global SERIALS
+        lock_dir = tempfile.mkdtemp()
+        try:
+            # A tiny counter so that lots of allocations spill over into
+            # following milliseconds
+            SERIALS = SerialAllocator(dict(serial_counter_bits=2,
+                                           serial_node_id=0,
+                                           serial_lock_dir=lock_dir))
+            workers = multiprocessing.Pool(4)
+            try:
+                results = workers.map(allocate_serials, [500] * 8)
+            finally:
+                workers.terminate()
+            results.append(allocate_serials(500))
+        finally:
+            shutil.rmtree(lock_dir)
+
+        serials = [serial for result in results for serial in result]
+        self.assertEqual(len(serials), 9 * 4 * 500)
+        self.assertEqual(len(set(serials)), len(serials))
+        self.assertTrue(max(serials) < 1 << 63)
+
+    def test_11_serial_layout(self):
+        # As mozsvc leaves them if they weren't plain integers
+        serials = SerialAllocator(dict(serial_node_id='5',
+                                       serial_worker_id='9',
+                                       serial_node_bits='6',
+                                       serial_worker_bits='10',
+                                       serial_counter_bits='6'))
+        serial = serials.allocate()
+        self.assertEqual((serial >> 6) & 0x3ff, 9)
+        self.assertEqual((serial >> 16) & 0x3f, 5)
+        self.assertRaises(ValueError, SerialAllocator,
+                          dict(serial_node_id=64, serial_worker_id=0))
+        # Every node needs its own ID so there's no default
+        self.assertRaises(ValueError, SerialAllocator,
+                          dict(serial_worker_id=0))
+
+    def test_11_serial_worker_slots(self):
+        # Slots are claimed in the lock dir, never taken from the PID
+        first = SerialAllocator(dict(serial_node_id=0,
+                                     serial_lock_dir=self.lock_dir))
+        second = SerialAllocator(dict(serial_node_id=0,
+                                      serial_lock_dir=self.lock_dir))
+        first.allocate()
+        second.allocate()
+        self.assertNotEqual(first.worker_id, second.worker_id)
+        first.slot.close()
+        second.slot.close()
+
+    def test_11_serial_lock_dir_checked(self):
+        self.assertRaises(ValueError, SerialAllocator,
+                          dict(serial_node_id=0))
+        self.assertRaises(ValueError, SerialAllocator,
+                          dict(serial_node_id=0,
+                               serial_lock_dir=self.lock_dir + '.missing'))
+        # Anyone else who could open the slot files could hold them
+        os.chmod(self.lock_dir, 0755)
+        self.assertRaises(ValueError, SerialAllocator,
+                          dict(serial_node_id=0,
+                               serial_lock_dir=self.lock_dir))
+        os.chmod(self.lock_dir, 0700)
+
     def tearDown(self):
         testing.tearDown()
+        shutil.rmtree(self.lock_dir)
+
+    def batch(self):
+        signature = b64encode(str(self._extract(True).signature))
+        return [dict(addon_id='batch_bougainvillea_%d' % i,
+                     filename='zigbert.sf', signature=signature)
+                for i in range(3)] + [
+                    dict(addon_id='x' * 65, filename='zigbert.sf',
+                         signature=signature),
+                    dict(addon_id='unparseable', filename='zigbert.sf',
+                         signature=b64encode('Not a signature file')),
+                    'not a dict!',
+                    dict(addon_id='injected', signature=signature,
+                         filename='zigbert.sf"\r\nSet-Cookie: x=1')]
+
+    def test_12_sign_addon_batch(self):
+        request = StupidRequest(path='/1.0/sign_addon_batch',
+                                post=self.batch())
+        valid_addon_batch(request)
+        response = sign_addon_batch(request)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        results = [json.loads(line) for line in ''.join(response.app_iter)
+                   .splitlines()]
+        results.sort(key=lambda r: r['index'])
+
+        self.assertEqual([r['status'] for r in results],
+                         ['ok'] * 3 + ['error'] * 4)
+        self.assertEqual([r['code'] for r in results[3:]], [400] * 4)
+        for i in range(3):
+            signature = response_to_pkcs7(results[i]['signature'])
+            self.assertTrue(get_signature_cert_subject(signature)
+                            .endswith("CN=batch_bougainvillea_%d" % i))
+            self.assertEqual(results[i]['filename'], 'zigbert.rsa')
+
+    def test_13_sign_addon_batch_multipart(self):
+        request = StupidRequest(path='/1.0/sign_addon_batch',
+                                post=self.batch()[2:4],
+                                accept=MIMEAccept('multipart/mixed'))
+        valid_addon_batch(request)
+        response = sign_addon_batch(request)
+        self.assertEqual(response.content_type, 'multipart/mixed')
+        boundary = response.content_type_params['boundary']
+        body = ''.join(response.app_iter)
+        self.assertTrue(body.endswith('--%s--\r\n' % boundary))
+        parts = body.split('--%s' % boundary)[1:-1]
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            headers, content = part.split('\r\n\r\n', 1)
+            if 'X-Batch-Index: 0' in headers:
+                self.assertTrue('application/pkcs7-signature' in headers)
+                self.assertTrue(response_to_pkcs7(b64encode(content[:-2])))
+            else:
+                self.assertTrue('application/json' in headers)
+                self.assertEqual(json.loads(content)['code'], 400)
+
+    def test_13_batch_keys_from_worker_processes(self):
+        global KEYGEN_PIDS
+        KEYGEN_PIDS = tempfile.mkdtemp()
+        settings = self.config.registry.settings
+        factory = crypto.KEYSTORE.factory
+        factory.processes = 2
+        settings['addons.batch_workers'] = 2
+        views.BATCH_POOL = None
+        ephemeral.generate_pem = generate_pem_recording_pid
+        try:
+            request = StupidRequest(path='/1.0/sign_addon_batch',
+                                    post=self.batch()[:3] * 2)
+            valid_addon_batch(request)
+            results = [json.loads(line) for line in
+                       ''.join(sign_addon_batch(request).app_iter)
+                       .splitlines()]
+            self.assertEqual([r['status'] for r in results], ['ok'] * 6)
+            # The keys were generated by both worker processes, neither of
+            # which is this one
+            pids = os.listdir(KEYGEN_PIDS)
+            self.assertEqual(len(pids), 2)
+            self.assertFalse(str(os.getpid()) in pids)
+        finally:
+            ephemeral.generate_pem = generate_pem
+            views.BATCH_POOL = None
+            factory.workers.terminate()
+            shutil.rmtree(KEYGEN_PIDS)
+
+    def test_14_validate_addon_batch(self):
+        for post in ({}, [], ['x'] * 101):
+            request = StupidRequest(path='/1.0/sign_addon_batch', post=post)
+            self.assertRaises(HTTPBadRequest, valid_addon_batch, request)
+
+        self.config.registry.settings['addons.batch_limit'] = '1'
+        request = StupidRequest(path='/1.0/sign_addon_batch', post=['x'] * 2)
+        self.assertRaises(HTTPBadRequest, valid_addon_batch, request)
+
+    def test_15_sign_archive(self):
+        class ArchiveFile(FormFile):
+            def __init__(self, filename, path):
+                self.filename = filename
+                self.file = open(path, 'rb')
+
+        archive = ArchiveFile('test-jar.xpi', 'trunion/tests/test-jar.zip')
+        request = StupidRequest(path='/1.0/sign_archive',
+                                post=dict(file=archive))
+        self.assertRaises(HTTPBadRequest, valid_archive, request)
+
+        archive.file.seek(0)
+        request = StupidRequest(path='/1.0/sign_archive',
+                                post=dict(addon_id='zipped_bougainvillea',
+                                          file=archive))
+        valid_archive(request)
+        response = sign_archive(request)
+        signed = zipfile.ZipFile(StringIO(''.join(response.app_iter)))
+        self.assertEqual(signed.read('META-INF/zigbert.sf'),
+                         self._extract(True).signature)
+        signature = response_to_pkcs7(
+            b64encode(signed.read('META-INF/zigbert.rsa')))
+        self.assertTrue(get_signature_cert_subject(signature)
+                        .endswith("CN=zipped_bougainvillea"))
+        archive.file.close()
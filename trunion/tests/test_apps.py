@@ -4,16 +4,26 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+from base64 import b64encode
 from cStringIO import StringIO
 import os
+import struct
+import threading
+import zipfile
 
 from pyramid import testing
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPRequestEntityTooLarge,
+                                    HTTPUnsupportedMediaType)
+from webob.acceptparse import MIMEAccept
 from mozsvc.config import load_into_settings
 from mozsvc.tests.support import TestCase
-from trunion.tests.base import StupidRequest
+from trunion.tests.base import StupidRequest, response_to_pkcs7
 
 from signing_clients.apps import JarExtractor
-from trunion.views import sign_app
+from trunion.jar import StreamingJarExtractor
+import trunion.jar as jar
+from trunion.validators import valid_app, valid_archive
+from trunion.views import sign_app, sign_archive
 import trunion.crypto as crypto
 
 
@@ -105,7 +115,208 @@ SHA1-Digest: lys436ZGYKrHY6n57Iy/EyF5FuI=
         extracted = self._extract(True)
         post = dict(file=formfile('zigbert.sf', extracted))
         request = StupidRequest(path="/1.0/sign_app", post=post)
+        valid_app(request)
         response = sign_app(request)
 
+    def test_05_sign_app_raw(self):
+        extracted = self._extract(True)
+        request = StupidRequest(path="/1.0/sign_app", post={},
+                                params=dict(filename='zigbert.sf'),
+                                content_type='application/octet-stream',
+                                body=str(extracted.signature))
+        valid_app(request)
+        response = sign_app(request)
+        self.assertTrue(response_to_pkcs7(response['zigbert.rsa']))
+
+    def test_05_sign_app_filenames(self):
+        signature = str(self._extract(True).signature)
+        for filename in ('zigbert.sf"\r\nSet-Cookie: x=1', 'zig"bert.sf',
+                         'zigbert.sf\x00', '', 'META-INF/'):
+            request = StupidRequest(path="/1.0/sign_app", post={},
+                                    params=dict(filename=filename),
+                                    content_type='application/octet-stream',
+                                    body=signature)
+            self.assertRaises(HTTPBadRequest, valid_app, request)
+
+        request = StupidRequest(path="/1.0/sign_app", post={},
+                                params=dict(filename='../META-INF/zigbert.sf'),
+                                content_type='application/octet-stream',
+                                body=signature)
+        valid_app(request)
+        self.assertEqual(request.validated['filename'], 'zigbert.sf')
+
+    def test_05_sign_app_der(self):
+        extracted = self._extract(True)
+        accept = MIMEAccept('application/pkcs7-signature')
+        request = StupidRequest(path="/1.0/sign_app", post={},
+                                params=dict(filename='zigbert.sf'),
+                                content_type='application/octet-stream',
+                                body=str(extracted.signature), accept=accept)
+        valid_app(request)
+        response = sign_app(request)
+        self.assertEqual(response.content_type, 'application/pkcs7-signature')
+        self.assertEqual(response.content_disposition,
+                         'attachment; filename="zigbert.rsa"')
+        self.assertTrue(response_to_pkcs7(b64encode(response.body)))
+
+        # JSON is still the default
+        request.accept = MIMEAccept('*/*')
+        response = sign_app(request)
+        self.assertTrue(response_to_pkcs7(response['zigbert.rsa']))
+
+    def test_06_sign_app_threaded(self):
+        data = str(self._extract(True).signature)
+        results = []
+        contexts = []
+
+        def sign():
+            contexts.append(crypto.KEYSTORE.smime_context())
+            for i in range(10):
+                results.append(crypto.sign_app(data))
+
+        threads = [threading.Thread(target=sign) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 40)
+        self.assertEqual(len(set(id(c) for c in contexts)), 4)
+        for result in results:
+            response_to_pkcs7(b64encode(result))
+
     def tearDown(self):
         testing.tearDown()
+
+    def test_07_streaming_extractor(self):
+        extracted = StreamingJarExtractor('trunion/tests/test-jar.zip')
+        self.assertEqual(str(extracted.manifest), self.MANIFEST)
+        self.assertEqual(str(extracted.signatures), self.SIGNATURES)
+
+    def test_08_sign_archive(self):
+        with open('trunion/tests/test-jar.zip', 'rb') as f:
+            unsigned = f.read()
+        request = StupidRequest(path="/1.0/sign_archive", post={},
+                                params=dict(filename='test-jar.zip'),
+                                content_type='application/octet-stream',
+                                body_file=StringIO(unsigned))
+        valid_archive(request)
+        response = sign_archive(request)
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertEqual(response.content_disposition,
+                         'attachment; filename="test-jar.zip"')
+        body = ''.join(response.app_iter)
+        self.assertEqual(len(body), response.content_length)
+
+        signed = zipfile.ZipFile(StringIO(body))
+        original = zipfile.ZipFile(StringIO(unsigned))
+        self.assertEqual(signed.namelist()[0], 'META-INF/zigbert.rsa')
+        self.assertEqual(signed.read('META-INF/manifest.mf'), self.MANIFEST)
+        self.assertEqual(signed.read('META-INF/zigbert.sf'), self.SIGNATURE)
+        self.assertTrue(response_to_pkcs7(
+            b64encode(signed.read('META-INF/zigbert.rsa'))))
+        for name in original.namelist():
+            self.assertEqual(signed.read(name), original.read(name))
+
+        # Signing a signed archive replaces the old signature
+        request = StupidRequest(path="/1.0/sign_archive", post={},
+                                params=dict(filename='test-jar.zip'),
+                                content_type='application/octet-stream',
+                                body_file=StringIO(body))
+        valid_archive(request)
+        resigned = zipfile.ZipFile(StringIO(
+            ''.join(sign_archive(request).app_iter)))
+        self.assertEqual(sorted(resigned.namelist()),
+                         sorted(signed.namelist()))
+        self.assertEqual(resigned.read('META-INF/manifest.mf'),
+                         self.MANIFEST)
+
+    def test_09_invalid_archive(self):
+        with open('trunion/tests/test-jar.zip', 'rb') as f:
+            unsigned = f.read()
+        for body in ('not a zip', unsigned[:len(unsigned) / 2]):
+            request = StupidRequest(path="/1.0/sign_archive", post={},
+                                    params=dict(filename='test-jar.zip'),
+                                    content_type='application/octet-stream',
+                                    body_file=StringIO(body))
+            self.assertRaises(HTTPBadRequest, valid_archive, request)
+
+        request = StupidRequest(path="/1.0/sign_archive", post={})
+        self.assertRaises(HTTPBadRequest, valid_archive, request)
+
+        request = StupidRequest(path="/1.0/sign_archive", post={},
+                                params=dict(filename='x.zip"\r\nX-Evil: 1'),
+                                content_type='application/octet-stream',
+                                body_file=StringIO(unsigned))
+        self.assertRaises(HTTPBadRequest, valid_archive, request)
+
+        # Nothing is read unless this signs apps or add-ons
+        settings = self.config.registry.settings
+        settings['trunion.we_are_signing'] = 'receipts'
+        body = StringIO(unsigned)
+        request = StupidRequest(path="/1.0/sign_archive", post={},
+                                params=dict(filename='test-jar.zip'),
+                                content_type='application/octet-stream',
+                                body_file=body)
+        self.assertRaises(HTTPUnsupportedMediaType, valid_archive, request)
+        self.assertEqual(body.tell(), 0)
+        settings['trunion.we_are_signing'] = 'apps'
+
+        self.config.registry.settings['trunion.archive_max_entries'] = '1'
+        request = StupidRequest(path="/1.0/sign_archive", post={},
+                                params=dict(filename='test-jar.zip'),
+                                content_type='application/octet-stream',
+                                body_file=StringIO(unsigned))
+        self.assertRaises(HTTPBadRequest, valid_archive, request)
+
+    def archive_request(self, body, **kwargs):
+        return StupidRequest(path="/1.0/sign_archive", post={},
+                             params=dict(filename='test-jar.zip'),
+                             content_type='application/octet-stream',
+                             body_file=StringIO(body), **kwargs)
+
+    def test_10_archive_limits(self):
+        with open('trunion/tests/test-jar.zip', 'rb') as f:
+            unsigned = f.read()
+        settings = self.config.registry.settings
+
+        # Too big to be worth reading, going by its length
+        settings['trunion.archive_max_bytes'] = str(len(unsigned) - 1)
+        request = self.archive_request(unsigned,
+                                       content_length=len(unsigned))
+        self.assertRaises(HTTPRequestEntityTooLarge, valid_archive, request)
+        self.assertEqual(request.body_file.tell(), 0)
+        # Or once it's been read, without one
+        request = self.archive_request(unsigned)
+        self.assertRaises(HTTPRequestEntityTooLarge, valid_archive, request)
+        settings['trunion.archive_max_bytes'] = str(len(unsigned))
+        self.assertTrue(valid_archive(self.archive_request(unsigned)))
+
+        # Unpacks to more than is allowed, turned away before reading any
+        # of it
+        total = sum(info.file_size for info in
+                    zipfile.ZipFile(StringIO(unsigned)).infolist())
+        settings['trunion.archive_max_uncompressed'] = str(total - 1)
+        digested = []
+        digest_entry = jar.digest_entry
+        jar.digest_entry = lambda zin, info: digested.append(info)
+        try:
+            self.assertRaises(HTTPRequestEntityTooLarge, valid_archive,
+                              self.archive_request(unsigned))
+        finally:
+            jar.digest_entry = digest_entry
+        self.assertEqual(digested, [])
+        settings['trunion.archive_max_uncompressed'] = str(total)
+        self.assertTrue(valid_archive(self.archive_request(unsigned)))
+
+    def test_11_archive_understating_sizes(self):
+        archive = StringIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('bomb.txt', 'a' * 1000000)
+        data = archive.getvalue()
+        # Claim far less than it unpacks to in the central directory
+        header = data.index('PK\x01\x02')
+        data = (data[:header + 24] + struct.pack('<I', 10)
+                + data[header + 28:])
+        self.assertRaises(HTTPBadRequest, valid_archive,
+                          self.archive_request(data))
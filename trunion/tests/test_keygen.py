@@ -0,0 +1,101 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+from M2Crypto import EVP
+from mozsvc.tests.support import TestCase
+
+from trunion.ephemeral import EphemeralFactory
+from trunion.keygen import KeygenClient, KeygenServer
+
+
+class TrunionKeygenTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'keygen.sock')
+        self.server = KeygenServer(self.path, 512, processes=1, capacity=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def test_00_socket_permissions(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(mode, 0600)
+
+    def test_01_client(self):
+        client = KeygenClient(self.path, 512, timeout=5)
+        key = client.get()
+        self.assertTrue(isinstance(key, EVP.PKey))
+        self.assertEqual(key.size(), 64)
+
+    def test_02_wrong_key_size(self):
+        client = KeygenClient(self.path, 1024, timeout=5)
+        self.assertEqual(client.get(), None)
+
+    def test_03_factory_falls_back(self):
+        settings = dict(ephemeral_key_size=512,
+                        ephemeral_keygen_socket=self.path + '.missing')
+        e = EphemeralFactory(settings, dict(O='Allizom, Cni.'))
+        self.assertEqual(e.keygen.get(), None)
+        key, req = e.new('fallback')
+        self.assertEqual(req.get_pubkey().as_der(), key.as_der())
+
+    def test_04_settings_from_ini(self):
+        # As mozsvc leaves them, floats aren't converted
+        settings = dict(ephemeral_key_size=512,
+                        ephemeral_keygen_socket=self.path,
+                        ephemeral_keygen_timeout='5.0')
+        e = EphemeralFactory(settings, dict(O='Allizom, Cni.'))
+        self.assertTrue(isinstance(e.keygen.get(), EVP.PKey))
+
+    def test_05_client_falls_back_on_any_error(self):
+        client = KeygenClient(self.path, 512, timeout=5)
+        client.timeout = 'not a number'
+        self.assertEqual(client.get(), None)
+
+    def starve(self):
+        # Take the one key generated at startup and make no more
+        self.server.fill = lambda: None
+        return self.server.keys.get(timeout=10)
+
+    def test_06_starved_server_answers_in_time(self):
+        self.server.wait = 5
+        pem = self.starve()
+        client = KeygenClient(self.path, 512, timeout=0.3)
+        start = time.time()
+        self.assertEqual(client.get(), None)
+        self.assertTrue(time.time() - start < 0.3)
+
+        # A key that turns up afterwards is still there for the next client
+        self.server.keys.put(pem)
+        time.sleep(0.1)
+        self.assertTrue(isinstance(client.get(), EVP.PKey))
+
+    def test_07_undelivered_key_is_requeued(self):
+        self.server.wait = 5
+        pem = self.starve()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall('512 5\n')
+        sock.close()
+        time.sleep(0.1)
+        # The client has gone by the time the key is ready
+        self.server.keys.put(pem)
+        time.sleep(0.2)
+        self.assertEqual(self.server.keys.qsize(), 1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
@@ -0,0 +1,137 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+import logging
+import logging.config
+import os
+import signal
+import tempfile
+import threading
+
+from mozsvc.tests.support import TestCase
+
+from trunion.logqueue import QueueHandler
+
+
+class Target(logging.Handler):
+
+    def __init__(self, gate=None):
+        logging.Handler.__init__(self)
+        self.gate = gate
+        self.records = []
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait()
+        self.records.append(record.getMessage())
+
+
+CONFIG = """
+[loggers]
+keys = root, queued
+
+[handlers]
+keys = queue, target
+
+[formatters]
+keys =
+
+[logger_root]
+handlers =
+
+[logger_queued]
+level = INFO
+handlers = queue
+qualname = trunion.tests.queued
+propagate = 0
+
+[handler_queue]
+class = trunion.logqueue.QueueHandler
+args = (10,)
+target = target
+
+[handler_target]
+class = trunion.tests.test_logqueue.Target
+args = ()
+level = WARNING
+"""
+
+
+class TrunionLogQueueTest(TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('trunion.tests.logqueue')
+        self.logger.propagate = False
+        self.handlers = []
+
+    def queue(self, *args, **kwargs):
+        handler = QueueHandler(*args, **kwargs)
+        self.logger.addHandler(handler)
+        self.handlers.append(handler)
+        return handler
+
+    def test_00_records_reach_target(self):
+        target = Target()
+        handler = self.queue(10, target)
+        self.logger.warning('hello %s', 'world')
+        handler.close()
+        self.assertEqual(target.records, ['hello world'])
+
+    def test_01_full_queue_drops(self):
+        gate = threading.Event()
+        target = Target(gate)
+        handler = self.queue(2, target)
+        for n in range(10):
+            self.logger.warning('record %d', n)
+        # One may have been taken off the queue by the listener already
+        self.assertTrue(handler.dropped >= 7)
+        self.assertEqual(handler.stats()['capacity'], 2)
+        gate.set()
+        handler.close()
+        self.assertEqual(len(target.records), 10 - handler.dropped + 1)
+        self.assertEqual(target.records[-1],
+                         'Log queue full, dropped %d records'
+                         % handler.dropped)
+
+    def test_02_file_config(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(CONFIG)
+        try:
+            logging.config.fileConfig(path, disable_existing_loggers=False)
+        finally:
+            os.unlink(path)
+        logger = logging.getLogger('trunion.tests.queued')
+        handler = logger.handlers[0]
+        self.assertTrue(isinstance(handler, QueueHandler))
+        logger.info('not for the target')
+        logger.warning('for the target')
+        handler.close()
+        self.assertEqual(handler.target.records, ['for the target'])
+        logger.removeHandler(handler)
+
+    def test_03_fork_gets_fresh_queue(self):
+        target = Target()
+        handler = self.queue(10, target)
+        self.logger.warning('parent')
+        # Fork while the queue's lock is held, as another thread putting a
+        # record on it might have it
+        with handler.queue.mutex:
+            pid = os.fork()
+            if pid == 0:
+                # Killed by the alarm if it deadlocks
+                signal.alarm(5)
+                self.logger.warning('child')
+                handler.close()
+                os._exit(0 if target.records[-1:] == ['child'] else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        handler.close()
+        self.assertEqual(target.records, ['parent'])
+
+    def tearDown(self):
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
@@ -4,10 +4,25 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import jwt
+from M2Crypto import EC, RSA
 from pyramid.httpexceptions import HTTPBadRequest, HTTPConflict
 
+import trunion.crypto as crypto
+from trunion.key_certify import certificate, certify_key
 from trunion.tests.base import StupidRequest, TrunionTest
-from trunion.validators import valid_receipt
+from trunion.validators import (RejectionLog, ReceiptChecker, valid_receipt,
+                                valid_receipt_batch, valid_verify)
+from trunion.verifier import ReceiptVerifier, VerificationError
+from trunion.views import sign_receipt, sign_receipt_batch, verify_receipt
 
 
 class ValidateTest(TrunionTest):
@@ -23,6 +38,10 @@ class ValidateTest(TrunionTest):
                                           iss="Big Bob's Rodeo Dairy!"))
         self.assertRaises(HTTPConflict, valid_receipt, request)
 
+        request = StupidRequest(path=self.path,
+                                post=dict(self._template, iss=['unhashable']))
+        self.assertRaises(HTTPConflict, valid_receipt, request)
+
     def test_validate_nbf(self):
         request = StupidRequest(path=self.path,
                                 post=dict(self._template, nbf=0))
@@ -100,6 +119,12 @@ class ValidateTest(TrunionTest):
                                                 'value': 'hal@9000'}))
         self.assertRaises(HTTPBadRequest, valid_receipt, request)
 
+        request = StupidRequest(path=self.path,
+                                post=dict(self._template,
+                                          user={'type': 'email',
+                                                'value': ['a@b.com']}))
+        self.assertRaises(HTTPBadRequest, valid_receipt, request)
+
     def test_validate_product(self):
         request = StupidRequest(path=self.path,
                                 post=dict(self._template,
@@ -127,6 +152,12 @@ class ValidateTest(TrunionTest):
         request = StupidRequest(path=self.path, post=post)
         self.assertRaises(HTTPBadRequest, valid_receipt, request)
 
+        for product in ({'url': 1, 'storedata': '5169314356'},
+                        {'url': 'https://grumpybadgers.com', 'storedata': 1}):
+            request = StupidRequest(path=self.path,
+                                    post=dict(self._template, product=product))
+            self.assertRaises(HTTPBadRequest, valid_receipt, request)
+
     def test_validate_protocol(self):
         for url in ['http://f.com', 'https://f.com', 'app://f.com']:
             assert StupidRequest(path=self.path,
@@ -147,3 +178,345 @@ class ValidateTest(TrunionTest):
         #                      'storedata': 200.01}))
         # request = StupidRequest(path=self.path, post=post)
         # self.assertRaises(HTTPBadRequest, valid_receipt, request)
+
+
+class Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RejectionLogTest(TrunionTest):
+
+    def setUp(self):
+        super(RejectionLogTest, self).setUp()
+        self.now = 0
+        self.handler = Records()
+        self.logger = logging.getLogger('trunion.tests.rejections')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.logs = []
+
+    def log(self, *args):
+        log = RejectionLog(*args)
+        self.logs.append(log)
+        return log
+
+    def checker(self, sample_rate):
+        log = self.log(60, sample_rate, self.logger, lambda: self.now)
+        return ReceiptChecker(['https://donkeykong.com'], self.signing, log)
+
+    def test_summary(self):
+        check = self.checker(0)
+        for n in range(3):
+            self.assertRaises(HTTPConflict, check, dict(self._template))
+        self.assertRaises(HTTPBadRequest, check, 'not a dict!')
+        self.assertEqual(self.handler.records, [])
+
+        self.now = 60
+        self.assertRaises(HTTPBadRequest, check, 'not a dict!')
+        self.assertEqual(len(self.handler.records), 1)
+        self.assertEqual(self.handler.records[0].getMessage(),
+                         'rejected 5 receipts in the last 60 seconds: '
+                         'bad issuer: 3, not a dict: 2')
+
+    def test_summary_after_quiet_spell(self):
+        log = self.log(0.1, 0, self.logger)
+        log.reject('bad issuer')
+        for i in range(100):
+            if self.handler.records:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.handler.records), 1)
+        self.assertTrue(self.handler.records[0].getMessage().startswith(
+            'rejected 1 receipts in the last '))
+
+    def test_sampled_details(self):
+        check = self.checker(1)
+        receipt = dict(self._template, iss='https://donkeykong.com', iat=0)
+        self.assertRaises(HTTPConflict, check, receipt)
+        self.assertEqual(len(self.handler.records), 1)
+        self.assertTrue(self.handler.records[0].getMessage().startswith(
+            'invalid receipt: receipt iat 1970-01-01 00:00:00 < iat '))
+
+    def tearDown(self):
+        # Rather than at exit, once the handler is gone
+        for log in self.logs:
+            log.flush()
+        self.logger.removeHandler(self.handler)
+        super(RejectionLogTest, self).tearDown()
+
+
+class BatchTest(TrunionTest):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.path = '/1.0/sign_batch'
+
+    def test_validate_batch_envelope(self):
+        request = StupidRequest(path=self.path, post=dict(self._template))
+        self.assertRaises(HTTPBadRequest, valid_receipt_batch, request)
+
+        request = StupidRequest(path=self.path, post=[])
+        self.assertRaises(HTTPBadRequest, valid_receipt_batch, request)
+
+        request = StupidRequest(path=self.path,
+                                post=[dict(self._template)] * 1001)
+        self.assertRaises(HTTPBadRequest, valid_receipt_batch, request)
+
+        request = StupidRequest(path=self.path,
+                                post=[dict(self._template)] * 2)
+        self.assertTrue(valid_receipt_batch(request))
+
+        # Settings made outside of mozsvc's config loader stay strings
+        self.config.registry.settings['trunion.batch_limit'] = '1'
+        self.assertRaises(HTTPBadRequest, valid_receipt_batch, request)
+
+    def test_sign_batch_reports_errors_in_order(self):
+        post = [dict(self._template),
+                dict(self._template, iss="Big Bob's Rodeo Dairy!"),
+                'not a dict!',
+                dict(self._template, user={}),
+                dict(self._template,
+                     product=dict(self._template['product'], storedata=1))]
+        request = StupidRequest(path=self.path, post=post)
+        valid_receipt_batch(request)
+        results = sign_receipt_batch(request)['receipts']
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['status'], 'ok')
+        self.assertEqual(len(results[0]['receipt'].split('~')), 2)
+        self.assertEqual(results[1]['status'], 'error')
+        self.assertEqual(results[1]['code'], 409)
+        self.assertEqual(results[2]['code'], 400)
+        self.assertEqual(results[3]['code'], 400)
+        self.assertEqual(results[4]['code'], 400)
+
+
+class EncodeTest(TrunionTest):
+
+    def test_encode_jwt(self):
+        token = crypto.sign_jwt(self._template)
+        header, payload, signature = token.split('.')
+        self.assertEqual(json.loads(jwt.base64url_decode(header)),
+                         dict(alg='RS256', typ='JWT',
+                              jku=self.signing['iss']))
+        self.assertEqual(jwt.decode(token, verify=False), self._template)
+        digest = hashlib.sha256(header + '.' + payload).digest()
+        self.assertTrue(crypto.KEYSTORE.rsa.verify(
+            digest, jwt.base64url_decode(signature), 'sha256'))
+
+    def test_encode_jwt_is_deterministic(self):
+        reordered = dict(reversed(self._template.items()))
+        self.assertEqual(crypto.sign_jwt(self._template),
+                         crypto.sign_jwt(reordered))
+
+
+class SignCacheTest(TrunionTest):
+
+    def setUp(self):
+        super(SignCacheTest, self).setUp()
+        crypto.init_sign_cache(2, 30)
+
+    def test_retry_is_not_signed_again(self):
+        request = StupidRequest(path=self.path, post=dict(self._template))
+        first = sign_receipt(request)['receipt']
+        # The same receipt, keys in another order
+        reordered = dict(reversed(self._template.items()))
+        request = StupidRequest(path=self.path, post=reordered)
+        self.assertEqual(sign_receipt(request)['receipt'], first)
+        self.assertEqual(crypto.sign_cache_stats()['hits'], 1)
+
+        request = StupidRequest(path=self.path,
+                                post=dict(self._template, nbf=0))
+        self.assertNotEqual(sign_receipt(request)['receipt'], first)
+        self.assertEqual(crypto.sign_cache_stats()['misses'], 2)
+
+    def test_ttl_and_eviction(self):
+        cache = crypto.SigningCache(2, 30)
+        cache.put('a', 1, now=0)
+        self.assertEqual(cache.get('a', now=29), 1)
+        self.assertEqual(cache.get('a', now=30), None)
+
+        cache.put('a', 1, now=0)
+        cache.put('b', 2, now=0)
+        cache.get('a', now=1)
+        cache.put('c', 3, now=1)
+        self.assertEqual(cache.get('b', now=1), None)
+        self.assertEqual(cache.get('a', now=1), 1)
+        self.assertEqual(cache.get('c', now=1), 3)
+
+    def tearDown(self):
+        crypto.init_sign_cache(0, 0)
+        super(SignCacheTest, self).tearDown()
+
+
+class ES256Test(TrunionTest):
+
+    def setUp(self):
+        super(ES256Test, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        ec = EC.gen_params(EC.NID_X9_62_prime256v1)
+        ec.gen_key()
+        keyfile = os.path.join(self.tmpdir, 'ec_key.pem')
+        certfile = os.path.join(self.tmpdir, 'ec_crt.jwk')
+        ec.save_key(keyfile, None)
+        # Certified by the regular RS256 test key
+        with open(certfile, 'w') as f:
+            f.write(certify_key(ec, self.signing['exp'], 10,
+                                issuer=self.signing['iss'],
+                                issued_at=self.signing['iat']))
+        self.keystore = crypto.KeyStore(keyfile, certfile)
+
+    def test_certificate_jwk(self):
+        jwk = self.keystore.cert_data['jwk'][0]
+        self.assertEqual(jwk['alg'], 'EC')
+        self.assertEqual(jwk['crv'], 'P-256')
+        self.assertEqual(len(jwt.base64url_decode(str(jwk['x']))), 32)
+        self.assertEqual(len(jwt.base64url_decode(str(jwk['y']))), 32)
+
+    def test_encode_decode(self):
+        token = self.keystore.encode_jwt(self._template)
+        header, payload, signature = token.split('.')
+        self.assertEqual(json.loads(jwt.base64url_decode(header))['alg'],
+                         'ES256')
+        self.assertEqual(len(jwt.base64url_decode(signature)), 64)
+        self.assertEqual(self.keystore.decode_jwt(token), self._template)
+
+        tampered = '.'.join([header, jwt.base64url_encode('{}'), signature])
+        self.assertRaises(jwt.DecodeError, self.keystore.decode_jwt, tampered)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ES256Test, self).tearDown()
+
+
+class VerifyTest(TrunionTest):
+
+    def setUp(self):
+        super(VerifyTest, self).setUp()
+        self.path = '/1.0/verify'
+        self.tmpdir = tempfile.mkdtemp()
+        here = os.path.dirname(__file__)
+        self.root_jwk = os.path.join(here, 'test_root_pub.jwk')
+        root = crypto.KeyStore(os.path.join(here, 'test_root_key.pem'),
+                               os.path.join(here, 'test_crt.jwk'))
+        # A signing key certified by the test root rather than our own
+        leaf = RSA.gen_key(1024, 0x10001, lambda: None)
+        keyfile = os.path.join(self.tmpdir, 'leaf_key.pem')
+        certfile = os.path.join(self.tmpdir, 'leaf_crt.jwk')
+        leaf.save_key(keyfile, None)
+        with open(certfile, 'w') as f:
+            f.write(root.encode_jwt(certificate(
+                leaf, self.signing['exp'], 10, issuer=self.signing['iss'],
+                issued_at=self.signing['iat'])))
+        self.leaf = crypto.KeyStore(keyfile, certfile)
+        self.verifier = ReceiptVerifier(crypto.KEYSTORE, [self.root_jwk])
+        self.now = self.signing['iat']
+
+    def receipt(self, keystore):
+        return '~'.join([keystore.certificate,
+                         keystore.encode_jwt(self._template)])
+
+    def test_own_receipt(self):
+        receipt = self.receipt(crypto.KEYSTORE)
+        self.assertEqual(self.verifier.verify(receipt, self.now),
+                         self._template)
+        # The test certificate has long since expired
+        self.assertRaises(VerificationError, self.verifier.verify, receipt)
+
+    def test_trusted_root(self):
+        receipt = self.receipt(self.leaf)
+        self.assertEqual(self.verifier.verify(receipt, self.now),
+                         self._template)
+        self.assertEqual(self.verifier.certs.stats()['size'], 1)
+        self.assertEqual(self.verifier.verify(receipt, self.now),
+                         self._template)
+
+        untrusted = ReceiptVerifier(crypto.KEYSTORE)
+        self.assertRaises(VerificationError, untrusted.verify, receipt,
+                          self.now)
+
+    def test_receipt_validity(self):
+        for changes in (dict(nbf=self.now + 60), dict(exp=self.now - 1),
+                        dict(exp='never'), dict(nbf=True)):
+            self._template.update(changes)
+            self.assertRaises(VerificationError, self.verifier.verify,
+                              self.receipt(self.leaf), self.now)
+            self._template['nbf'] = self.now
+            self._template.pop('exp', None)
+
+        self._template['exp'] = self.now + 60
+        self.assertEqual(self.verifier.verify(self.receipt(self.leaf),
+                                              self.now),
+                         self._template)
+        self.assertRaises(VerificationError, self.verifier.verify,
+                          self.receipt(self.leaf), self.now + 61)
+
+    def test_keystore_without_expiry(self):
+        # A bare JWK rather than a certificate
+        certfile = os.path.join(self.tmpdir, 'bare.jwk')
+        with open(certfile, 'w') as f:
+            json.dump({'jwk': [{'kid': 'bare', 'iss': 'bare'}]}, f)
+        keystore = crypto.KeyStore(self.config.registry.settings[
+            'trunion.keyfile'], certfile)
+        verifier = ReceiptVerifier(keystore)
+        self.assertRaises(VerificationError, verifier.verify,
+                          self.receipt(keystore), self.now)
+
+    def test_tampered(self):
+        cert, token = self.receipt(self.leaf).split('~')
+        header, payload, signature = token.split('.')
+        tampered = '.'.join([header, jwt.base64url_encode('{}'), signature])
+        self.assertRaises(VerificationError, self.verifier.verify,
+                          cert + '~' + tampered, self.now)
+        self.assertRaises(VerificationError, self.verifier.verify,
+                          token, self.now)
+        self.assertRaises(VerificationError, self.verifier.verify,
+                          'garbage~' + token, self.now)
+
+        # Issuers that can't be looked up are untrusted, not errors
+        for iss in (['x'], {'x': 1}):
+            forged = '.'.join([header,
+                               jwt.base64url_encode(json.dumps({'iss': iss})),
+                               signature])
+            self.assertRaises(VerificationError, self.verifier.verify,
+                              forged + '~' + token, self.now)
+
+    def test_validate_verify(self):
+        request = StupidRequest(path=self.path, post=dict(self._template))
+        self.assertRaises(HTTPBadRequest, valid_verify, request)
+
+        request = StupidRequest(path=self.path, post=[])
+        self.assertRaises(HTTPBadRequest, valid_verify, request)
+
+        request = StupidRequest(path=self.path, post=['x'] * 1001)
+        self.assertRaises(HTTPBadRequest, valid_verify, request)
+
+        request = StupidRequest(path=self.path, post='x')
+        self.assertTrue(valid_verify(request))
+
+        self.config.registry.settings['trunion.batch_limit'] = '1'
+        request = StupidRequest(path=self.path, post=['x'] * 2)
+        self.assertRaises(HTTPBadRequest, valid_verify, request)
+
+    def test_verify_view(self):
+        request = StupidRequest(path=self.path,
+                                post=self.receipt(crypto.KEYSTORE))
+        result = verify_receipt(request)
+        self.assertEqual(result['status'], 'invalid')
+        self.assertEqual(result['reason'], 'certificate has expired')
+
+        request = StupidRequest(path=self.path,
+                                post=[self.receipt(crypto.KEYSTORE), 42])
+        results = verify_receipt(request)['receipts']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]['reason'], 'receipt is not a string')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(VerifyTest, self).tearDown()
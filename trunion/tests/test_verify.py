@@ -0,0 +1,508 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+from browserid.errors import ExpiredSignatureError, InvalidIssuerError
+import jwt
+from M2Crypto import EC, RSA
+from mozsvc.tests.support import TestCase
+
+import trunion.crypto as crypto
+import trunion.key_certify as key_certify
+from trunion.key_certify import certificate, generate_root
+import trunion.verify as verify
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path,
+                                    self.headers.get('If-None-Match')))
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            status, headers, body = server.responses[self.path]
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves canned responses by path and counts the requests made"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.delay = delay
+        self.responses = {}
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+JWK = {'alg': 'RSA', 'mod': 'AQAB', 'exp': 'AQAB'}
+KEY_DOCUMENT = json.dumps({'jwk': [JWK]})
+
+
+def keystore(directory, name, pem, cert):
+    keyfile = os.path.join(directory, name + '.pem')
+    certfile = os.path.join(directory, name + '.jwk')
+    with open(keyfile, 'w') as f:
+        f.write(pem)
+    with open(certfile, 'w') as f:
+        f.write(cert)
+    return crypto.KeyStore(keyfile, certfile)
+
+
+class KeyConversionTest(TestCase):
+
+    def setUp(self):
+        self.rsa = RSA.gen_key(512, 0x10001, lambda: None)
+        self.ec = EC.gen_params(EC.NID_X9_62_prime256v1)
+        self.ec.gen_key()
+
+    def tearDown(self):
+        pass
+
+    def test_jwk_left_alone_and_key_reused(self):
+        jwk = key_certify.jwk(self.rsa, 'reused')
+        original = dict(jwk)
+        key = verify.jwk_to_key(jwk, 'RS256')
+        self.assertEqual(jwk, original)
+        # An identical JWK, not necessarily the same dict, gets the same key
+        self.assertTrue(verify.jwk_to_key(dict(original), 'RS256') is key)
+        signature = self.rsa.sign(hashlib.sha256('data').digest(), 'sha256')
+        self.assertTrue(key.verify('data', signature))
+
+    def test_es256(self):
+        jwk = key_certify.jwk(self.ec, 'es256')
+        key = verify.jwk_to_key(jwk, 'ES256')
+        self.assertTrue(isinstance(key, verify.ES256Key))
+        self.assertTrue(verify.jwk_to_key(dict(jwk), 'ES256') is key)
+
+        r, s = self.ec.sign_dsa(hashlib.sha256('data').digest())
+        signature = (crypto.mpint_to_bytes(r, crypto.ES256_SIZE)
+                     + crypto.mpint_to_bytes(s, crypto.ES256_SIZE))
+        self.assertTrue(key.verify('data', signature))
+        self.assertFalse(key.verify('other data', signature))
+        self.assertFalse(key.verify('data', signature[:-1]))
+        self.assertFalse(key.verify('data', '\x00' * len(signature)))
+
+    def test_unsupported_ec(self):
+        jwk = key_certify.jwk(self.ec, 'es256')
+        self.assertRaises(ValueError, verify.load_jwk, jwk, 'ES384')
+        jwk['crv'] = 'P-384'
+        self.assertRaises(ValueError, verify.load_jwk, jwk, 'ES256')
+
+
+class ReceiptVerifierTest(TestCase):
+
+    ISSUER = 'https://root.example.com/root.jwk'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = int(time.time())
+        pem, jwk = generate_root(512, self.now + 3600, self.ISSUER)
+        self.root = keystore(self.tmpdir, 'root', pem,
+                             json.dumps({'jwk': [{'iss': self.ISSUER}]}))
+        self.leaf = RSA.gen_key(512, 0x10001, lambda: None)
+        self.verifier = self.verifier_with(json.loads(jwk)['jwk'][0])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def verifier_with(self, root_jwk, **kwargs):
+        verifier = verify.ReceiptVerifier(certs={self.ISSUER: root_jwk},
+                                          warning=False, **kwargs)
+        verifier.chains_checked = 0
+        check = verifier.verify_certificate_chain
+
+        def counted(*args, **kwargs):
+            verifier.chains_checked += 1
+            return check(*args, **kwargs)
+        verifier.verify_certificate_chain = counted
+        return verifier
+
+    def receipt(self, issued_at=None, expires=3600):
+        # Certificates issued at different times make different chains
+        issued_at = issued_at or self.now
+        cert = self.root.encode_jwt(certificate(
+            self.leaf, issued_at + expires, 10, issuer=self.ISSUER,
+            issued_at=issued_at))
+        signer = keystore(self.tmpdir, 'leaf', self.leaf.as_pem(None), cert)
+        return cert + '~' + signer.encode_jwt({'exp': self.now + 3600})
+
+    def test_chain_cached(self):
+        receipt = self.receipt()
+        self.assertTrue(self.verifier.verify(receipt, now=self.now))
+        self.assertTrue(self.verifier.verify(receipt, now=self.now))
+        self.assertEqual(self.verifier.chains_checked, 1)
+        self.assertEqual(self.verifier.chain_cache.stats()['hits'], 1)
+
+    def test_chain_cache_eviction(self):
+        verifier = self.verifier_with(self.verifier.certs[self.ISSUER],
+                                      chain_cache_size=2)
+        receipts = [self.receipt(self.now - i) for i in range(3)]
+        for receipt in receipts:
+            verifier.verify(receipt, now=self.now)
+        self.assertEqual(verifier.chain_cache.stats()['entries'], 2)
+        # The most recent two are still there, the first has to be redone
+        verifier.verify(receipts[2], now=self.now)
+        self.assertEqual(verifier.chains_checked, 3)
+        verifier.verify(receipts[0], now=self.now)
+        self.assertEqual(verifier.chains_checked, 4)
+
+    def test_expired_chain_not_cached(self):
+        receipt = self.receipt(expires=60)
+        self.assertTrue(self.verifier.verify(receipt, now=self.now))
+        self.assertRaises(ExpiredSignatureError, self.verifier.verify,
+                          receipt, now=self.now + 120)
+        self.assertEqual(self.verifier.chains_checked, 2)
+
+
+class PublicKeyFetcherTest(TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetcher = verify.PublicKeyFetcher(timeout=5,
+                                               cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def serve(self, path, status=200, body=KEY_DOCUMENT, **headers):
+        self.server.responses[path] = (
+            status, dict((k.replace('_', '-'), v)
+                         for k, v in headers.items()), body)
+        return self.server.url(path)
+
+    def test_cache_lifetime(self):
+        for value, expected in (('max-age=60', 60),
+                                ('public, max-age="120"', 120),
+                                ('max-age=-5', 0),
+                                ('max-age=soon', 10),
+                                ('no-cache', 0),
+                                ('no-store, max-age=60', None),
+                                ('', 10)):
+            self.assertEqual(
+                verify.cache_lifetime({'cache-control': value}, 10),
+                expected)
+        self.assertEqual(verify.cache_lifetime({}, 10), 10)
+
+    def test_cached_in_memory_and_on_disk(self):
+        url = self.serve('/key', Cache_Control='max-age=60')
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # A fresh fetcher, as in another process, finds it on disk
+        fetcher = verify.PublicKeyFetcher(timeout=5, cache_dir=self.cache_dir)
+        self.assertEqual(fetcher.fetch(url), JWK)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_store(self):
+        url = self.serve('/key', Cache_Control='no-store')
+        self.fetcher.fetch(url)
+        self.fetcher.fetch(url)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_etag_revalidation(self):
+        url = self.serve('/key', Cache_Control='no-cache', ETag='"v1"')
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.serve('/key', 304, '', ETag='"v1"')
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.assertEqual(self.server.requests,
+                         [('/key', None), ('/key', '"v1"')])
+
+    def test_negative_caching(self):
+        url = self.serve('/missing', 404, 'Not here')
+        self.assertRaises(InvalidIssuerError, self.fetcher.fetch, url)
+        self.assertRaises(InvalidIssuerError, self.fetcher.fetch, url)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_stale_key_outlives_failed_refresh(self):
+        url = self.serve('/key', Cache_Control='no-cache')
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.serve('/key', 500, 'Down for maintenance')
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.serve('/key', 200, 'not a key document')
+        self.fetcher.entries[url].expires = 0
+        self.assertEqual(self.fetcher.fetch(url), JWK)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_single_flight(self):
+        self.server.delay = 0.3
+        url = self.serve('/key', Cache_Control='max-age=60')
+        results = []
+
+        def fetch():
+            results.append(self.fetcher.fetch(url))
+
+        threads = [threading.Thread(target=fetch) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [JWK] * 5)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class ConcurrentReceiptVerifierTest(TestCase):
+
+    ISSUERS = 4
+
+    def setUp(self):
+        self.server = StubServer(delay=0.3)
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = int(time.time())
+        self.leaf = RSA.gen_key(512, 0x10001, lambda: None)
+        self.receipts = []
+        for n in range(self.ISSUERS):
+            self.receipts.extend(self.issue('/root%d.jwk' % n, 3))
+        # An issuer whose key can't be had
+        self.missing = self.issue('/missing.jwk', 1, 404)
+        self.verifier = verify.ConcurrentReceiptVerifier(
+            certs=verify.PublicKeys(verify.PublicKeyFetcher(timeout=5)),
+            warning=False, per_host=2)
+
+    def tearDown(self):
+        self.verifier.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def issue(self, path, count, status=200):
+        url = self.server.url(path)
+        pem, jwk = generate_root(512, self.now + 3600, url)
+        self.server.responses[path] = (status, {}, jwk)
+        name = os.path.basename(path)
+        root = self.keystore(name + '-root', pem,
+                             json.dumps({'jwk': [{'iss': url}]}))
+        cert = root.encode_jwt(certificate(self.leaf, self.now + 3600, 10,
+                                           issuer=url, issued_at=self.now))
+        signer = self.keystore(name + '-leaf', self.leaf.as_pem(None), cert)
+        return [cert + '~' + signer.encode_jwt({'exp': self.now + 60, 'i': i})
+                for i in range(count)]
+
+    def keystore(self, name, pem, cert):
+        return keystore(self.tmpdir, name, pem, cert)
+
+    def test_verify_many(self):
+        start = time.time()
+        results = self.verifier.verify_many(self.receipts + self.missing,
+                                            now=self.now)
+        elapsed = time.time() - start
+
+        self.assertEqual(results[:-1], [True] * len(self.receipts))
+        self.assertTrue(isinstance(results[-1], InvalidIssuerError))
+        # Each issuer's key was fetched once, never more than two at a time
+        # from the one host, so five 0.3s fetches took three rounds
+        self.assertEqual(len(self.server.requests), self.ISSUERS + 1)
+        self.assertEqual(self.server.peak, 2)
+        self.assertTrue(0.9 <= elapsed < 1.5, elapsed)
+
+
+class BulkVerifyTest(TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = int(time.time())
+        self.issuer = self.server.url('/root.jwk')
+        pem, jwk = generate_root(512, self.now + 3600, self.issuer)
+        self.server.responses['/root.jwk'] = (200, {}, jwk)
+        self.root = keystore(self.tmpdir, 'root', pem,
+                             json.dumps({'jwk': [{'iss': self.issuer}]}))
+        self.leaf = RSA.gen_key(512, 0x10001, lambda: None)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def receipts(self, count, issued_at):
+        cert = self.root.encode_jwt(certificate(
+            self.leaf, self.now + 3600, 10, issuer=self.issuer,
+            issued_at=issued_at))
+        signer = keystore(self.tmpdir, 'leaf', self.leaf.as_pem(None), cert)
+        return [cert + '~' + signer.encode_jwt({'exp': self.now + 60, 'i': i})
+                for i in range(count)]
+
+    def write_input(self, lines):
+        path = os.path.join(self.tmpdir, 'receipts.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def read_output(self, path):
+        with open(path) as f:
+            return dict((r['line'], r) for r in map(json.loads, f))
+
+    def test_chunk_receipts(self):
+        receipts = [(n, 'chain%d~receipt%d' % (n % 2, n)) for n in range(10)]
+        chunks = list(verify.chunk_receipts(receipts, window=6,
+                                            chunk_size=2))
+        # Grouped by chain within each window of six, never more than two
+        self.assertEqual([[n for n, r in chunk] for chunk in chunks],
+                         [[0, 2], [4], [1, 3], [5], [6, 8], [7, 9]])
+        self.assertEqual(list(verify.read_receipts(['a\n', '\n', ' b \n'])),
+                         [(1, 'a'), (3, 'b')])
+
+    def test_verify_bulk(self):
+        lines = (self.receipts(3, self.now) + ['', 'not a receipt']
+                 + self.receipts(2, self.now - 1))
+        output = os.path.join(self.tmpdir, 'results.txt')
+        with open(self.write_input(lines)) as stream:
+            with open(output, 'w') as out:
+                counts = verify.verify_bulk(stream, out, processes=2,
+                                            window=4, chunk_size=2,
+                                            now=self.now)
+        self.assertEqual(counts, dict(valid=5, invalid=1))
+
+        results = self.read_output(output)
+        # The blank line is skipped but still counts for line numbers
+        self.assertEqual(sorted(results), [1, 2, 3, 5, 6, 7])
+        self.assertFalse(results[5]['valid'])
+        self.assertEqual(results[5]['error'], 'ValueError')
+        for line in (1, 2, 3, 6, 7):
+            self.assertTrue(results[line]['valid'])
+        # Each worker fetched the root key at most once
+        self.assertTrue(len(self.server.requests) <= 2)
+
+    def bulk_main(self, lines, output):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            status = verify.bulk_main([self.write_input(lines), '-o', output,
+                                       '-p', '1', '--now', str(self.now)])
+            return status, sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+    def test_bulk_main_exit_status(self):
+        output = os.path.join(self.tmpdir, 'results.txt')
+        self.assertEqual(self.bulk_main(self.receipts(2, self.now), output),
+                         (0, '2 valid, 0 invalid\n'))
+        self.assertEqual(len(self.read_output(output)), 2)
+
+        lines = self.receipts(1, self.now) + ['not a receipt']
+        self.assertEqual(self.bulk_main(lines, output),
+                         (1, '1 valid, 1 invalid\n'))
+        self.assertEqual(len(self.read_output(output)), 2)
+
+
+class RevocationIndexTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'revoked.idx')
+        self.revoked = [verify.revocation_key(jti=u'jti-%d' % i)
+                        for i in range(1000)]
+        self.revoked.append(verify.revocation_key(iss=u'https://iss',
+                                                  storedata=u'store 1'))
+        # Small chunks so the external merge sort has something to merge,
+        # and duplicates which only count once
+        self.assertEqual(verify.build_revocation_index(
+            self.revoked + self.revoked[:10], self.path, chunk_size=100),
+            len(self.revoked))
+        self.index = verify.RevocationIndex(self.path, check_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookups(self):
+        for key in self.revoked:
+            self.assertTrue(key in self.index)
+        misses = sum(verify.revocation_key(jti=u'other-%d' % i) in self.index
+                     for i in range(1000))
+        self.assertEqual(misses, 0)
+
+        self.assertTrue(self.index.is_revoked({'jti': u'jti-5'}))
+        self.assertTrue(self.index.is_revoked(
+            {'iss': u'https://iss', 'product': {'storedata': u'store 1'}}))
+        self.assertFalse(self.index.is_revoked(
+            {'iss': u'https://iss', 'product': {'storedata': u'store 2'}}))
+
+    def test_untrusted_payloads(self):
+        # Not yet verified so anything could be in there
+        for payload in ({'jti': 5}, {'jti': ['jti-5']},
+                        {'iss': 1, 'product': {'storedata': u'store 1'}},
+                        {'iss': u'https://iss', 'product': {'storedata': 1}},
+                        {'product': 'store 1'}, {}):
+            self.assertFalse(self.index.is_revoked(payload))
+
+    def test_revoked_receipt(self):
+        verifier = verify.ReceiptVerifier(certs={}, warning=False,
+                                          revocations=self.index)
+        claims = jwt.base64url_encode(json.dumps({'exp': time.time() + 60,
+                                                  'jti': 'jti-5'}))
+        receipt = 'x.y.z~' + '.'.join([jwt.base64url_encode('{"alg":"RS256"}'),
+                                       claims, 'sig'])
+        self.assertRaises(verify.RevokedReceiptError, verifier.verify,
+                          receipt)
+
+    def test_broken_index(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        truncated = os.path.join(self.tmpdir, 'truncated.idx')
+        with open(truncated, 'wb') as f:
+            f.write(data[:-4])
+        self.assertRaises(ValueError, verify.RevocationIndex, truncated)
+        with open(truncated, 'wb') as f:
+            f.write('NOTANIDX' + data[8:])
+        self.assertRaises(ValueError, verify.RevocationIndex, truncated)
+
+    def test_reload(self):
+        added = verify.revocation_key(jti=u'added')
+        self.assertFalse(added in self.index)
+        verify.build_revocation_index([added], self.path)
+        self.assertTrue(added in self.index)
+        self.assertFalse(self.revoked[0] in self.index)
+
+        # A broken replacement is ignored in favour of what's mapped
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        broken = os.path.join(self.tmpdir, 'broken.idx')
+        with open(broken, 'wb') as f:
+            f.write(data[:-4])
+        os.rename(broken, self.path)
+        self.assertTrue(added in self.index)
@@ -3,16 +3,28 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
+import atexit
+from base64 import b64decode
 from datetime import datetime
 import logging
+import os
+import random
 import re
+import tempfile
+import threading
 import time
+import zipfile
+import zlib
 
-from pyramid.httpexceptions import HTTPBadRequest, HTTPConflict
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPConflict,
+                                    HTTPRequestEntityTooLarge,
+                                    HTTPUnsupportedMediaType)
 
-import crypto
 from signing_clients.apps import ParsingError, Signature
 
+from jar import (CHUNK_SIZE, ArchiveError, ArchiveTooLarge,
+                 StreamingJarExtractor)
+
 
 # From https://github.com/mozilla/browserid/blob/dev/lib/sanitize.js
 EMAIL_REGEX = re.compile(
@@ -32,81 +44,246 @@ def valid_receipt(request, now=None):
     except ValueError:
         raise HTTPBadRequest('Invalid JSON')
 
-    if now is None:
-        now = long(time.time())
+    CHECKER(receipt, now)
 
-    for key in ('detail', 'verify', 'user', 'product', 'iss', 'iat', 'nbf'):
-        if key not in receipt:
-            raise HTTPBadRequest('missing %s' % key)
 
-    # Verify the time windows
-    #
-    # Note: these checks should really reflect a window of opportunity taking
-    #       clock drift and processing queue length/times into account
-    #
-    # Also, if we aren't going to revoke then the checks against signing['exp']
-    # should definitely include a window
-    signing = crypto.KEYSTORE.cert_data
-    if (receipt['iss'] not in
-            request.registry.settings['trunion.permitted_issuers']):
-        raise HTTPConflict("Bad issuer: \"%s\"" % receipt['iss'])
-    for receipt_key in ('iat', 'nbf'):
-        if not isinstance(receipt[receipt_key], (int, long, float)):
-            logging.warning(
-                'invalid receipt: non-numeric timestamp for {key}: "{val}"; '
-                'receipt: {receipt}'
-                .format(key=receipt_key, val=receipt[receipt_key],
-                        receipt=receipt))
-            raise HTTPConflict('non-numeric timestamp for {key}'
-                               .format(key=receipt_key))
-    if receipt['nbf'] < signing['iat']:
-        logging.warning('invalid receipt: nbf {nbf} < iat {iat} of '
-                        'signing cert; receipt: {receipt}'
-                        .format(nbf=datetime.utcfromtimestamp(receipt['nbf']),
-                                iat=datetime.utcfromtimestamp(signing['iat']),
-                                receipt=receipt))
-        raise HTTPConflict("nbf(not before) of receipt < iat(issued at) of "
-                           "signing cert")
-    if receipt['nbf'] > signing['exp']:
-        logging.warning('invalid receipt: nbf {nbf} > exp {exp} of '
-                        'signing cert; receipt: {receipt}'
-                        .format(nbf=datetime.utcfromtimestamp(receipt['nbf']),
-                                exp=datetime.utcfromtimestamp(signing['exp']),
-                                receipt=receipt))
-        raise HTTPConflict("nbf(not before) of receipt > exp(expires at) of "
-                           "signing cert")
-    if receipt['iat'] < signing['iat']:
-        logging.warning('invalid receipt: receipt iat {r} < iat {c} of '
-                        'signing cert; receipt: {receipt}'
-                        .format(r=datetime.utcfromtimestamp(receipt['iat']),
-                                c=datetime.utcfromtimestamp(signing['iat']),
-                                receipt=receipt))
-        raise HTTPConflict("iat(issued at) of receipt < iat(issued at) of "
-                           "signing cert")
-    if receipt['iat'] > signing['exp']:
-        logging.warning('invalid receipt: iat {iat} > exp {exp} of '
-                        'signing cert; receipt: {receipt}'
-                        .format(iat=datetime.utcfromtimestamp(receipt['iat']),
-                                exp=datetime.utcfromtimestamp(signing['exp']),
-                                receipt=receipt))
-        raise HTTPConflict("iat(issued at) of receipt > exp(expires at) of "
-                           "signing cert")
-    if receipt['iat'] > now:
-        logging.warning('invalid receipt: iat {iat} > now {now}; '
-                        'receipt: {receipt}'
-                        .format(iat=datetime.utcfromtimestamp(receipt['iat']),
-                                now=datetime.utcfromtimestamp(now),
-                                receipt=receipt))
-        raise HTTPConflict("iat(issued at) of receipt is in the future")
+def valid_receipt_batch(request):
+    """
+    Only the envelope of a batch is checked here.  Each receipt in it is
+    validated on its own by the view so that one bad receipt doesn't fail the
+    whole batch.
+    """
+    try:
+        receipts = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Invalid JSON')
+
+    if type(receipts) != list:
+        raise HTTPBadRequest('Invalid batch: not a list')
 
+    if len(receipts) < 1:
+        raise HTTPBadRequest('Invalid batch: no receipts provided')
+
+    limit = int(request.registry.settings.get('trunion.batch_limit', 1000))
+    if len(receipts) > limit:
+        raise HTTPBadRequest('Invalid batch: more than %d receipts' % limit)
+
+    return True
+
+
+def valid_verify(request):
+    """
+    The body is either a single certified receipt as a JSON string or a list
+    of them.  As with batch signing only the envelope is checked here.
+    """
     try:
-        valid_user(receipt['user'])
-        valid_product(receipt['product'])
-    except Exception, exc:
-        logging.warning('invalid receipt: invalid user or product: '
-                        '{exc.__class__.__name__}: {exc}; receipt: {receipt}'
-                        .format(exc=exc, receipt=receipt))
-        raise
+        receipts = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Invalid JSON')
+
+    if isinstance(receipts, basestring):
+        return True
+
+    if type(receipts) != list:
+        raise HTTPBadRequest('Invalid body: not a receipt or a list of them')
+
+    if len(receipts) < 1:
+        raise HTTPBadRequest('Invalid batch: no receipts provided')
+
+    limit = int(request.registry.settings.get('trunion.batch_limit', 1000))
+    if len(receipts) > limit:
+        raise HTTPBadRequest('Invalid batch: more than %d receipts' % limit)
+
+    return True
+
+
+RECEIPT_KEYS = ('detail', 'verify', 'user', 'product', 'iss', 'iat', 'nbf')
+NUMERIC = (int, long, float)
+
+
+class UTC(object):
+    """A timestamp that is only turned into a datetime if it's logged"""
+
+    __slots__ = ('timestamp',)
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def __str__(self):
+        return str(datetime.utcfromtimestamp(self.timestamp))
+
+
+class RejectionLog(object):
+    """
+    Rejected receipts are counted by reason and a summary of the counts is
+    logged once every interval seconds rather than a warning per receipt.
+    The summary is written by the next rejection once the interval is up or
+    by a background thread, so counts are never held back by a quiet spell,
+    and once more at exit.  The details of only sample_rate of the
+    rejections, receipt included, are logged and those are only formatted
+    if the logger actually emits them.
+    """
+
+    def __init__(self, interval=60, sample_rate=0.01, logger=None,
+                 clock=time.time):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.logger = logger or logging.getLogger('trunion.rejections')
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.started = clock()
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            # The thread doesn't survive a fork so each process gets its own
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        thread = threading.Thread(target=self.run, name='trunion-rejections')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def reject(self, reason, detail=None, *args):
+        if self.pid != os.getpid():
+            self.start()
+        now = self.clock()
+        counts = None
+        with self.lock:
+            self.counts[reason] = self.counts.get(reason, 0) + 1
+            if now - self.started >= self.interval:
+                counts, self.counts = self.counts, {}
+                elapsed, self.started = now - self.started, now
+        if counts is not None:
+            self.summarize(counts, elapsed)
+        if detail is not None and random.random() < self.sample_rate:
+            self.logger.warning('invalid receipt: ' + detail, *args)
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            now = self.clock()
+            elapsed, self.started = now - self.started, now
+        if counts:
+            self.summarize(counts, elapsed)
+
+    def summarize(self, counts, elapsed):
+        self.logger.warning(
+            'rejected %d receipts in the last %d seconds: %s',
+            sum(counts.itervalues()), elapsed,
+            ', '.join('%s: %d' % item for item in sorted(counts.items())))
+
+
+class ReceiptChecker(object):
+    """
+    The receipt checks compiled for one set of permitted issuers and one
+    signing certificate.  Everything that doesn't depend on the receipt is
+    worked out up front so checking one is a single pass over its fields.
+    """
+
+    def __init__(self, permitted_issuers, signing, rejections=None):
+        self.issuers = frozenset(permitted_issuers)
+        self.required = frozenset(RECEIPT_KEYS)
+        self.signing_iat = signing['iat']
+        self.signing_exp = signing['exp']
+        self.rejections = rejections or RejectionLog()
+
+    def __call__(self, receipt, now=None):
+        rejections = self.rejections
+        if type(receipt) != dict:
+            rejections.reject('not a dict')
+            raise HTTPBadRequest('Invalid receipt: not a dict')
+
+        if not self.required.issubset(receipt):
+            for key in RECEIPT_KEYS:
+                if key not in receipt:
+                    rejections.reject('missing %s' % key)
+                    raise HTTPBadRequest('missing %s' % key)
+
+        iss, iat, nbf = receipt['iss'], receipt['iat'], receipt['nbf']
+        try:
+            permitted = iss in self.issuers
+        except TypeError:
+            permitted = False
+        if not permitted:
+            rejections.reject('bad issuer')
+            raise HTTPConflict("Bad issuer: \"%s\"" % iss)
+        for receipt_key, value in (('iat', iat), ('nbf', nbf)):
+            if not isinstance(value, NUMERIC):
+                rejections.reject('non-numeric ' + receipt_key,
+                                  'non-numeric timestamp for %s: "%s"; '
+                                  'receipt: %s', receipt_key, value, receipt)
+                raise HTTPConflict('non-numeric timestamp for {key}'
+                                   .format(key=receipt_key))
+
+        # Verify the time windows
+        #
+        # Note: these checks should really reflect a window of opportunity
+        #       taking clock drift and processing queue length/times into
+        #       account
+        #
+        # Also, if we aren't going to revoke then the checks against the
+        # signing cert's exp should definitely include a window
+        if nbf < self.signing_iat:
+            rejections.reject('nbf before cert iat',
+                              'nbf %s < iat %s of signing cert; receipt: %s',
+                              UTC(nbf), UTC(self.signing_iat), receipt)
+            raise HTTPConflict("nbf(not before) of receipt < iat(issued at) "
+                               "of signing cert")
+        if nbf > self.signing_exp:
+            rejections.reject('nbf after cert exp',
+                              'nbf %s > exp %s of signing cert; receipt: %s',
+                              UTC(nbf), UTC(self.signing_exp), receipt)
+            raise HTTPConflict("nbf(not before) of receipt > exp(expires at) "
+                               "of signing cert")
+        if iat < self.signing_iat:
+            rejections.reject('iat before cert iat',
+                              'receipt iat %s < iat %s of signing cert; '
+                              'receipt: %s',
+                              UTC(iat), UTC(self.signing_iat), receipt)
+            raise HTTPConflict("iat(issued at) of receipt < iat(issued at) "
+                               "of signing cert")
+        if iat > self.signing_exp:
+            rejections.reject('iat after cert exp',
+                              'iat %s > exp %s of signing cert; receipt: %s',
+                              UTC(iat), UTC(self.signing_exp), receipt)
+            raise HTTPConflict("iat(issued at) of receipt > exp(expires at) "
+                               "of signing cert")
+        if now is None:
+            now = long(time.time())
+        if iat > now:
+            rejections.reject('iat in the future',
+                              'iat %s > now %s; receipt: %s',
+                              UTC(iat), UTC(now), receipt)
+            raise HTTPConflict("iat(issued at) of receipt is in the future")
+
+        try:
+            valid_user(receipt['user'])
+            valid_product(receipt['product'])
+        except Exception, exc:
+            rejections.reject('invalid user or product',
+                              'invalid user or product: %s: %s; receipt: %s',
+                              exc.__class__.__name__, exc, receipt)
+            raise
+
+
+CHECKER = None
+
+
+def init(permitted_issuers, signing, rejections=None):
+    global CHECKER
+    CHECKER = ReceiptChecker(permitted_issuers, signing, rejections)
+
+
+def check_receipt(receipt, now=None):
+    return CHECKER(receipt, now)
 
 
 def valid_user(obj):
@@ -118,6 +295,8 @@ def valid_user(obj):
         raise HTTPBadRequest('Invalid user struct: invalid value')
     if obj['type'] not in ('email', 'directed-identifier'):
         raise HTTPBadRequest('Invalid user struct: unknown type')
+    if not isinstance(obj['value'], basestring):
+        raise HTTPBadRequest('Invalid user struct: invalid value')
     if obj['type'] == 'email' and not EMAIL_REGEX.match(obj['value']):
         raise HTTPBadRequest('Invalid user struct: invalid value')
     return True
@@ -130,6 +309,11 @@ def valid_product(obj):
         raise HTTPBadRequest('Invalid product struct: no URL provided')
     if 'storedata' not in obj:
         raise HTTPBadRequest('Invalid product struct: no storedata')
+    if not isinstance(obj['url'], basestring):
+        raise HTTPBadRequest('Invalid product struct: URL is not a string')
+    if not isinstance(obj['storedata'], basestring):
+        raise HTTPBadRequest('Invalid product struct: storedata is not a '
+                             'string')
     if not PROD_URL_REGEX.match(obj['url']):
         raise HTTPBadRequest(
             "Invalid product struct: URL doesn't look like "
@@ -140,12 +324,53 @@ def valid_product(obj):
     return True
 
 
+# Signature files can be sent as the request body instead of as a multipart
+# upload, with the rest of the parameters in the query string or headers.
+RAW_CONTENT_TYPE = 'application/octet-stream'
+
+# File names are sent back in Content-Disposition headers
+UNSAFE_FILENAME_REGEX = re.compile(r'["\\\x00-\x1f\x7f]')
+
+
+def is_raw(request):
+    return getattr(request, 'content_type', None) == RAW_CONTENT_TYPE
+
+
+def raw_param(request, name, header):
+    value = request.GET.get(name)
+    if value is None:
+        value = request.headers.get(header)
+    return value
+
+
+def read_upload(request):
+    """
+    Puts the name and contents of the signature file to be signed in
+    request.validated, whichever way it was sent.  This is the only place it
+    is read.
+    """
+    if is_raw(request):
+        filename = raw_param(request, 'filename', 'X-Signature-Filename')
+        data = request.body
+    else:
+        if 'file' not in request.POST:
+            raise HTTPBadRequest('no payload to sign')
+        upload = request.POST['file']
+        filename = upload.filename
+        data = upload.file.read()
+
+    request.validated['filename'] = check_filename(filename)
+    request.validated['signature'] = data
+    return data
+
+
 def valid_app(request):
     """
     Not much validating to do, really.  So much validation is done by the
     separate validation service that we rely pretty heavily on the client
     end of this request doing its job.
     """
+    read_upload(request)
     return True
 
 
@@ -158,29 +383,179 @@ def valid_addon(request):
     We can use the signing_clients signature parser to at least make sure the
     signature is nominally correctly formatted.
     """
-    if 'addon_id' not in request.POST:
+    if is_raw(request):
+        addon_id = raw_param(request, 'addon_id', 'X-Addon-Id')
+    else:
+        addon_id = request.POST.get('addon_id')
+
+    if addon_id is None:
         raise HTTPBadRequest('missing addon identifier')
 
-    if 'file' not in request.POST:
+    if not is_raw(request) and 'file' not in request.POST:
         raise HTTPBadRequest('no payload to sign')
 
-    if len(request.POST['addon_id']) < 1:
+    check_addon_id(addon_id)
+    check_signature(read_upload(request))
+
+    request.validated['addon_id'] = addon_id
+
+    return True
+
+
+def spool_upload(source, spool, limit):
+    size = 0
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise ArchiveTooLarge("more than %d bytes" % limit)
+        spool.write(chunk)
+    spool.flush()
+
+
+def valid_archive(request):
+    """
+    The archive is spooled to disk and walked once here, so a truncated or
+    otherwise broken one is turned away before anything is signed.  The
+    upload and the total size of what it unpacks to are both capped, the
+    latter going by the sizes the archive claims before any of it is read.
+    The spool is left in request.validated for the view to close.
+    """
+    settings = request.registry.settings
+    # Receipt signers have no business signing archives
+    signing = settings.get('trunion.we_are_signing')
+    if signing not in ('apps', 'addons'):
+        raise HTTPUnsupportedMediaType()
+
+    max_bytes = int(settings.get('trunion.archive_max_bytes',
+                                 100 * 1024 * 1024))
+    if is_raw(request):
+        filename = raw_param(request, 'filename', 'X-Archive-Filename')
+        addon_id = raw_param(request, 'addon_id', 'X-Addon-Id')
+        length = getattr(request, 'content_length', None)
+        if length is not None and length > max_bytes:
+            raise HTTPRequestEntityTooLarge('Archive is more than %d bytes'
+                                            % max_bytes)
+        source = request.body_file
+    else:
+        if 'file' not in request.POST:
+            raise HTTPBadRequest('no archive to sign')
+        upload = request.POST['file']
+        filename = upload.filename
+        addon_id = request.POST.get('addon_id')
+        source = upload.file
+
+    filename = check_filename(filename)
+
+    if signing == 'addons':
+        if addon_id is None:
+            raise HTTPBadRequest('missing addon identifier')
+        check_addon_id(addon_id)
+
+    spool = tempfile.NamedTemporaryFile(prefix='trunion-', suffix='.zip')
+    try:
+        spool_upload(source, spool, max_bytes)
+        limit = int(settings.get('trunion.archive_max_entries', 10000))
+        max_uncompressed = int(settings.get(
+            'trunion.archive_max_uncompressed', 500 * 1024 * 1024))
+        archive = StreamingJarExtractor(spool.name,
+                                        omit_signature_sections=True,
+                                        max_entries=limit,
+                                        max_uncompressed=max_uncompressed)
+    except ArchiveTooLarge, e:
+        spool.close()
+        raise HTTPRequestEntityTooLarge('Archive is too large: "%s"' % e)
+    except (ArchiveError, zipfile.BadZipfile, zipfile.LargeZipFile,
+            NotImplementedError, RuntimeError, zlib.error), e:
+        spool.close()
+        raise HTTPBadRequest('Provided archive does not unpack: "%s"' % e)
+    except:
+        spool.close()
+        raise
+
+    request.validated['filename'] = filename
+    request.validated['addon_id'] = addon_id
+    request.validated['archive'] = archive
+    request.validated['spool'] = spool
+    return True
+
+
+def valid_addon_batch(request):
+    """
+    As with receipts only the envelope of a batch is checked here.  Each item,
+    {"addon_id": ..., "filename": ..., "signature": base64}, is held to the
+    valid_addon rules on its own as it's signed.
+    """
+    try:
+        items = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Invalid JSON')
+
+    if type(items) != list:
+        raise HTTPBadRequest('Invalid batch: not a list')
+
+    if len(items) < 1:
+        raise HTTPBadRequest('Invalid batch: no add-ons provided')
+
+    limit = int(request.registry.settings.get('addons.batch_limit', 100))
+    if len(items) > limit:
+        raise HTTPBadRequest('Invalid batch: more than %d add-ons' % limit)
+
+    return True
+
+
+def check_filename(filename):
+    """
+    Returns the base name of filename, which has to be safe to put in a
+    quoted header parameter.
+    """
+    if filename:
+        filename = os.path.basename(filename)
+    if not filename:
+        raise HTTPBadRequest('missing filename')
+    if UNSAFE_FILENAME_REGEX.search(filename):
+        raise HTTPBadRequest('filename contains quotes or control '
+                             'characters: %r' % filename)
+    return filename
+
+
+def check_addon_id(addon_id):
+    if len(addon_id) < 1:
         raise HTTPBadRequest('addon_id is very short(<1 byte): "%s"'
-                             % request.POST['addon_id'])
+                             % addon_id)
 
     # 64 byte length limit is a function of the X509 spec's definition of the
     # CNAME attribute.
-    if len(request.POST['addon_id']) > 64:
+    if len(addon_id) > 64:
         raise HTTPBadRequest('addon_id is very long(>64 bytes): "%s"'
-                             % request.POST['addon_id'])
+                             % addon_id)
 
+
+def check_signature(data):
     try:
-        Signature.parse(request.POST['file'].file.read())
+        Signature.parse(data)
     except ParsingError, e:
         raise HTTPBadRequest('Provided XPI signature file does not parse: '
                              '"%s"' % e)
 
-    # Make certain to reset the file position
-    request.POST['file'].file.seek(0)
 
-    return True
+def check_addon_item(item):
+    """
+    The addon_id, file name and decoded signature file of one item of an
+    add-on batch, checked as valid_addon would.
+    """
+    if type(item) != dict:
+        raise HTTPBadRequest('Invalid item: not a dict')
+    for key in ('addon_id', 'filename', 'signature'):
+        if not isinstance(item.get(key), basestring):
+            raise HTTPBadRequest('missing %s' % key)
+
+    check_addon_id(item['addon_id'])
+    try:
+        data = b64decode(item['signature'])
+    except TypeError:
+        raise HTTPBadRequest('signature is not base64 encoded')
+    check_signature(data)
+    return item['addon_id'], check_filename(item['filename']), data
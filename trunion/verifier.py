@@ -0,0 +1,133 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+#
+# Local receipt verification.  Every key needed is loaded up front, the
+# service's own signing key and the trusted roots, so a receipt is checked
+# without ever going to the network.
+#
+
+import json
+import time
+
+import jwt
+
+import crypto
+
+
+class VerificationError(ValueError):
+    pass
+
+
+class ReceiptVerifier(object):
+    """
+    Verifies certified receipts, i.e. "certificate~receipt", signed either by
+    keystore itself or by a key certified by one of the trusted roots.  Roots
+    are indexed by their kid, which is what certificates name as their iss.
+    """
+
+    def __init__(self, keystore, roots=(), cache_size=100, cache_ttl=3600):
+        self.keystore = keystore
+        self.roots = {}
+        for name in roots:
+            self.load_root(name)
+        # Certificates that have been verified, each with its key and expiry.
+        # The expiry is checked every time so the TTL only bounds how long
+        # one is kept.
+        self.certs = crypto.SigningCache(cache_size, cache_ttl)
+
+    def load_root(self, name):
+        with open(name, 'r') as f:
+            for jwk in json.load(f)['jwk']:
+                self.roots[jwk['kid']] = crypto.PublicKey.from_jwk(jwk)
+
+    def verify(self, receipt, now=None):
+        """
+        Returns the claims of receipt if it checks out, otherwise raises
+        VerificationError with the reason.
+        """
+        if now is None:
+            now = long(time.time())
+        if not isinstance(receipt, basestring):
+            raise VerificationError("receipt is not a string")
+        try:
+            certificate, token = str(receipt).rsplit('~', 1)
+        except (ValueError, UnicodeError):
+            raise VerificationError("receipt has no certificate")
+
+        if certificate == self.keystore.certificate:
+            key = self.keystore
+            expires = self.keystore.cert_data.get('exp')
+            if expires is None:
+                raise VerificationError("certificate has no expiry")
+        else:
+            key, expires = self.certified_key(certificate, now)
+        if expires < now:
+            raise VerificationError("certificate has expired")
+
+        try:
+            claims = key.decode_jwt(token)
+        except jwt.DecodeError, e:
+            raise VerificationError("invalid receipt: %s" % e)
+        self.check_validity(claims, now)
+        return claims
+
+    def check_validity(self, claims, now):
+        # Receipts signed here carry an nbf but not necessarily an exp
+        if not isinstance(claims, dict):
+            raise VerificationError("receipt is not a JSON object")
+        for name in ('nbf', 'exp'):
+            value = claims.get(name)
+            if value is None:
+                continue
+            if (isinstance(value, bool)
+                    or not isinstance(value, (int, long, float))):
+                raise VerificationError("receipt %s is not a number" % name)
+        if claims.get('nbf', now) > now:
+            raise VerificationError("receipt is not yet valid")
+        if claims.get('exp', now) < now:
+            raise VerificationError("receipt has expired")
+
+    def certified_key(self, certificate, now):
+        entry = self.certs.get(certificate, now)
+        if entry is not None:
+            return entry
+
+        # Nothing in the certificate can be trusted until it's verified
+        try:
+            claims = jwt.decode(certificate, verify=False)
+            issuer = claims.get('iss')
+        except (jwt.DecodeError, ValueError, AttributeError):
+            raise VerificationError("malformed certificate")
+        root = None
+        if isinstance(issuer, basestring):
+            root = self.roots.get(issuer)
+        if root is None:
+            raise VerificationError("certificate issuer is not trusted")
+        try:
+            crypto.decode_jws(certificate, root)
+            entry = (crypto.PublicKey.from_jwk(claims['jwk'][0]),
+                     claims['exp'])
+        except jwt.DecodeError, e:
+            raise VerificationError("invalid certificate: %s" % e)
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise VerificationError("certificate has no usable key")
+
+        self.certs.put(certificate, entry, now)
+        return entry
+
+
+VERIFIER = None
+
+
+def init(keystore, roots=()):
+    global VERIFIER
+    if VERIFIER is None:
+        VERIFIER = ReceiptVerifier(keystore, roots)
+
+
+def verify(receipt, now=None):
+    return VERIFIER.verify(receipt, now)
@@ -0,0 +1,930 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+import browserid
+import browserid.certificates
+import browserid.jwt
+from browserid.verifiers import local
+from browserid.utils import unbundle_certs_and_assertion
+from browserid.utils import decode_bytes, encode_bytes
+from browserid.utils import decode_json_bytes, encode_json_bytes
+from browserid.errors import (ConnectionError, InvalidIssuerError,
+                              InvalidSignatureError, ExpiredSignatureError,
+                              TrustError)
+
+import M2Crypto
+import requests
+import requests.adapters
+from requests.exceptions import RequestException
+
+from trunion.crypto import ES256_SIZE, P256_SPKI_PREFIX, bytes_to_mpint
+
+from binascii import hexlify
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+from collections import OrderedDict, deque
+import argparse
+import hashlib
+import heapq
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import json
+import sys
+
+def fetch_public_key(url, *args, **kwargs):
+    """Fetch the public key from the given URL."""
+    # Try to find the public key.  If it can't be found then we
+    # raise an InvalidIssuerError.  Any other connection-related
+    # errors are passed back up to the caller.
+    return FETCHER.fetch(url)
+
+
+def parse_public_key(url, text):
+    try:
+        try:
+            return parse_jwt(text).payload['jwk'][0]
+        except ValueError:
+            return json.loads(text)['jwk'][0]
+    except (ValueError, KeyError):
+        raise InvalidIssuerError('Host %r has malformed public key '
+                                 'document' % url)
+
+
+def cache_lifetime(headers, default):
+    """Seconds a response may be reused for according to its Cache-Control.
+
+    None means it mustn't be stored at all.
+    """
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return max(0, int(directives['max-age']))
+    except (KeyError, ValueError):
+        return default
+
+
+class CachedPublicKey(object):
+
+    def __init__(self, key=None, error=None, expires=0, etag=None):
+        self.key = key
+        self.error = error
+        self.expires = expires
+        self.etag = etag
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.key
+
+
+class PublicKeyFetcher(object):
+    """Fetches issuer public keys over a pool of persistent connections.
+
+    Keys are cached in memory and, if cache_dir is given, on disk for as
+    long as the issuer's Cache-Control allows or default_ttl seconds if it
+    doesn't say.  Stale keys with an ETag are revalidated rather than fetched
+    again, and kept on if the issuer can't be reached.  Failures are
+    remembered for negative_ttl seconds so a broken issuer isn't hammered,
+    and concurrent misses for the same URL share a single request.
+    """
+
+    def __init__(self, timeout=5, cache_dir=None, default_ttl=3600,
+                 negative_ttl=30, pool_size=10):
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.entries = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and entry.expires > now:
+                return entry.result()
+            flight = self.inflight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[url] = threading.Event()
+
+        if not leader:
+            # Someone else is already fetching it so wait for them
+            flight.wait(2 * self.timeout)
+            with self.lock:
+                entry = self.entries.get(url)
+            if entry is None:
+                raise ConnectionError("Timed out waiting for %s" % url)
+            return entry.result()
+
+        try:
+            if entry is None:
+                entry = self.load(url)
+            if entry is None or entry.expires <= now:
+                entry = self.refresh(url, entry)
+        except Exception, e:
+            entry = self.failed(entry, e, now)
+        finally:
+            with self.lock:
+                if entry is not None:
+                    self.entries[url] = entry
+                del self.inflight[url]
+            flight.set()
+        return entry.result()
+
+    def refresh(self, url, stale):
+        now = time.time()
+        headers = {}
+        if stale is not None and stale.key is not None and stale.etag:
+            headers['If-None-Match'] = stale.etag
+        try:
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+        except RequestException, e:
+            msg = "Impossible to get %s. Reason: %s" % (url, str(e))
+            return self.failed(stale, ConnectionError(msg), now)
+
+        if response.status_code == 304 and 'If-None-Match' in headers:
+            key = stale.key
+        elif response.status_code == 200:
+            try:
+                key = parse_public_key(url, response.text)
+            except InvalidIssuerError, e:
+                return self.failed(stale, e, now)
+        else:
+            return self.failed(
+                stale,
+                InvalidIssuerError('Can not retrieve key from "%s"' % url),
+                now)
+
+        ttl = cache_lifetime(response.headers, self.default_ttl)
+        etag = response.headers.get('etag', stale and stale.etag)
+        entry = CachedPublicKey(key=key, expires=now + (ttl or 0), etag=etag)
+        if ttl is not None:
+            self.save(url, entry)
+        return entry
+
+    def failed(self, stale, error, now):
+        # A key that has merely gone stale is still the issuer's key as far
+        # as anyone knows, so keep using it and try again after negative_ttl
+        if stale is not None and stale.key is not None:
+            return CachedPublicKey(key=stale.key, etag=stale.etag,
+                                   expires=now + self.negative_ttl)
+        return CachedPublicKey(error=error, expires=now + self.negative_ttl)
+
+    def path(self, url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def load(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.path(url)) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get('url') != url:
+            return None
+        return CachedPublicKey(key=data['key'], expires=data['expires'],
+                               etag=data.get('etag'))
+
+    def save(self, url, entry):
+        if not self.cache_dir:
+            return
+        # Write and rename so other processes never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(url=url, key=entry.key, expires=entry.expires,
+                               etag=entry.etag), f)
+            os.rename(tmp, self.path(url))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+FETCHER = PublicKeyFetcher()
+
+
+class PublicKeys(object):
+    """Dictionary alike lookup of issuer public keys through FETCHER.
+
+    Stands in for PyBrowserID's CertificatesManager, whose own cache would
+    hold on to keys and errors regardless of what the issuer asked for.
+    """
+
+    def __init__(self, fetcher=None):
+        self.fetcher = fetcher or FETCHER
+
+    def __getitem__(self, url):
+        return self.fetcher.fetch(url)
+
+
+def parse_jwt(data):
+    """Parse a JWT from a string."""
+    header, payload, signature = data.split(".")
+    signed_data = header + "." + payload
+    try:
+        header = decode_json_bytes(header)
+    except KeyError:
+        raise ValueError("badly formed JWT header")
+    payload = decode_json_bytes(payload)
+    signature = decode_bytes(signature)
+    return ReceiptJWT(header, payload, signature, signed_data)
+
+
+class LRUCache(object):
+    """Simple thread safe LRU cache with optional per entry expiry times.
+
+    An entry put with an expiry time is treated as missing once get() is
+    called with a later time.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (now is not None and entry[1] is not None
+                                 and entry[1] < now):
+                self.misses += 1
+                return None
+            # Put it back at the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, expires=None):
+        if self.size < 1:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return dict(entries=len(self.entries), size=self.size,
+                    hits=self.hits, misses=self.misses)
+
+
+# Verification keys by the parts of the JWK that make them up.  Converting
+# the base64 encoded big numbers and building a key is a lot more work than
+# the signature check it is for.
+KEY_CACHE = LRUCache(256)
+
+
+def jwt_cert_to_key(jwtoken):
+    """Converts a JWT encapsulated JWK key into something usable by PyBrowserID.jwt"""
+    if type(jwtoken) != dict:
+        jwtoken = parse_jwt(jwtoken)
+    return jwk_to_key(jwtoken.payload['jwk'][0], jwtoken.header['alg'])
+
+
+def jwk_to_key(jwk, alg):
+    """Quick'n'simple format conversion, memoized in KEY_CACHE.
+
+    The JWK passed in is left as it was.
+    """
+    cache_key = (jwk.get('kid'), alg, jwk.get('mod'), jwk.get('exp'),
+                 jwk.get('crv'), jwk.get('x'), jwk.get('y'))
+    key = KEY_CACHE.get(cache_key)
+    if key is None:
+        key = load_jwk(jwk, alg)
+        KEY_CACHE.put(cache_key, key)
+    return key
+
+
+def load_jwk(jwk, alg):
+    if jwk['alg'] == 'EC':
+        if alg != 'ES256' or jwk.get('crv', 'P-256') != 'P-256':
+            raise ValueError("unsupported EC algorithm: %s" % alg)
+        return ES256Key(jwk)
+    data = dict(jwk)
+    data['e'] = long(hexlify(browserid.jwt.decode_bytes(jwk['exp'])), 16)
+    data['n'] = long(hexlify(browserid.jwt.decode_bytes(jwk['mod'])), 16)
+    return browserid.jwt.load_key(alg, data)
+
+
+class ES256Key(object):
+    """ECDSA P-256 verification key with the same verify() as PyBrowserID's"""
+
+    SIZE = ES256_SIZE
+
+    def __init__(self, data):
+        x = decode_bytes(data['x']).rjust(self.SIZE, '\x00')
+        y = decode_bytes(data['y']).rjust(self.SIZE, '\x00')
+        self.ec = M2Crypto.EC.pub_key_from_der(P256_SPKI_PREFIX
+                                               + '\x04' + x + y)
+
+    def verify(self, signed_data, signature):
+        if len(signature) != 2 * self.SIZE:
+            return False
+        digest = hashlib.sha256(signed_data).digest()
+        r, s = signature[:self.SIZE], signature[self.SIZE:]
+        try:
+            return bool(self.ec.verify_dsa(digest, bytes_to_mpint(r),
+                                           bytes_to_mpint(s)))
+        except M2Crypto.EC.ECError:
+            return False
+
+
+class ReceiptJWT(browserid.jwt.JWT):
+    """Class to override PyBrowserID's JWT parser"""
+
+    def __init__(self, header, payload, signature, signed_data):
+        self.header = header
+        self.algorithm = header['alg']
+        self.payload = payload
+        self.signature = signature
+        self.signed_data = signed_data
+
+    def check_signature(self, key_data):
+        """Do proper parsing of a JWS signed JWT as defined by
+        http://tools.ietf.org/html/draft-ietf-jose-json-web-signature-01"""
+        if not self.algorithm.startswith(key_data["alg"][0:1]):
+            return False
+        key = jwk_to_key(key_data, self.algorithm)
+        return key.verify(self.signed_data, self.signature)
+
+
+class RevokedReceiptError(TrustError):
+    pass
+
+
+#
+# Revocation index.  Revoked receipts are identified by their jti or by their
+# issuer and product storedata.  Each key is hashed to 64 bits and the file
+# holds a Bloom filter over those hashes followed by the sorted hashes
+# themselves:
+#
+#   header: magic, entry count, filter bits, hash count    (32 bytes)
+#   filter: filter bits / 8 bytes
+#   table:  entry count big endian 64 bit hashes, sorted
+#
+# Nearly every receipt isn't revoked and is turned away by the filter after
+# a handful of bit tests.  The rest get a binary search of the table.  The
+# file is mapped rather than read so only the pages touched stay resident.
+#
+
+REVOCATION_MAGIC = 'TRNREV01'
+REVOCATION_HEADER = struct.Struct('>8sQQI4x')
+REVOCATION_ENTRY = struct.Struct('>Q')
+
+
+def revocation_key(jti=None, iss=None, storedata=None):
+    if jti is not None:
+        return 'jti:' + jti.encode('utf-8')
+    return 'storedata:%s\t%s' % (iss.encode('utf-8'),
+                                 storedata.encode('utf-8'))
+
+
+def revocation_hash(key):
+    return REVOCATION_ENTRY.unpack(hashlib.sha256(key).digest()[:8])[0]
+
+
+def bloom_positions(value, bits, hashes):
+    # Double hashing with the two halves of the 64 bit hash
+    h1, h2 = value & 0xffffffff, (value >> 32) | 1
+    return [(h1 + i * h2) % bits for i in xrange(hashes)]
+
+
+class RevocationIndex(object):
+    """Memory mapped revocation index written by build_revocation_index.
+
+    The file is checked for changes at most every check_interval seconds and
+    remapped if it has been replaced, so a new index only needs to be renamed
+    into place.
+    """
+
+    def __init__(self, path, check_interval=30):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.index = self.open()
+        self.checked = time.time()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, bits, hashes = REVOCATION_HEADER.unpack_from(mapped)
+        if magic != REVOCATION_MAGIC:
+            raise ValueError("%s is not a revocation index" % self.path)
+        table = REVOCATION_HEADER.size + bits // 8
+        if len(mapped) != table + count * REVOCATION_ENTRY.size:
+            raise ValueError("%s is truncated" % self.path)
+        return (mapped, count, bits, hashes, table,
+                (st.st_ino, st.st_mtime, st.st_size))
+
+    def reload(self):
+        """Swap in the index on disk if it has changed since it was mapped"""
+        try:
+            st = os.stat(self.path)
+            if (st.st_ino, st.st_mtime, st.st_size) != self.index[5]:
+                self.index = self.open()
+        except (IOError, OSError, ValueError):
+            # Keep using what we have rather than failing open
+            pass
+
+    def maybe_reload(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if now - self.checked >= self.check_interval:
+                self.checked = now
+                self.reload()
+
+    def __contains__(self, key):
+        self.maybe_reload()
+        mapped, count, bits, hashes, table, _ = self.index
+        value = revocation_hash(key)
+        for bit in bloom_positions(value, bits, hashes):
+            if not ord(mapped[REVOCATION_HEADER.size + bit // 8]) \
+                    & (1 << (bit % 8)):
+                return False
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = REVOCATION_ENTRY.unpack_from(
+                mapped, table + mid * REVOCATION_ENTRY.size)[0]
+            if entry < value:
+                lo = mid + 1
+            elif entry > value:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def is_revoked(self, payload):
+        # Called before the receipt's signature is checked so nothing in the
+        # payload can be relied on.  Only strings are ever revoked.
+        jti = payload.get('jti')
+        if (isinstance(jti, basestring)
+                and revocation_key(jti=jti) in self):
+            return True
+        iss = payload.get('iss', u'')
+        product = payload.get('product')
+        if isinstance(product, dict):
+            storedata = product.get('storedata')
+            if (isinstance(iss, basestring)
+                    and isinstance(storedata, basestring)):
+                return revocation_key(iss=iss, storedata=storedata) in self
+        return False
+
+
+def build_revocation_index(keys, path, error_rate=0.001, chunk_size=1000000):
+    """Write the revocation index for an iterable of keys, as made by
+    revocation_key, to path.
+
+    The hashes are sorted in chunks on disk and merged so building an index
+    of tens of millions of keys doesn't need them all in memory at once.  The
+    index is written next to path and renamed over it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    chunks = []
+    count = 0
+    try:
+        batch = []
+        for key in keys:
+            batch.append(revocation_hash(key))
+            if len(batch) >= chunk_size:
+                chunks.append(spill_hashes(batch, directory))
+                count += len(batch)
+                batch = []
+        if batch:
+            chunks.append(spill_hashes(batch, directory))
+            count += len(batch)
+
+        # Sized on the count including duplicates, which only errs towards
+        # a sparser filter
+        bits = max(64, int(math.ceil(-max(count, 1) * math.log(error_rate)
+                                     / math.log(2) ** 2)))
+        bits += -bits % 8
+        hashes = max(1, int(round(bits / float(max(count, 1))
+                                  * math.log(2))))
+        bloom = bytearray(bits // 8)
+
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.seek(REVOCATION_HEADER.size + len(bloom))
+                written = 0
+                last = None
+                for value in heapq.merge(*[read_hashes(c) for c in chunks]):
+                    if value == last:
+                        continue
+                    last = value
+                    for bit in bloom_positions(value, bits, hashes):
+                        bloom[bit // 8] |= 1 << (bit % 8)
+                    out.write(REVOCATION_ENTRY.pack(value))
+                    written += 1
+                out.seek(0)
+                out.write(REVOCATION_HEADER.pack(REVOCATION_MAGIC, written,
+                                                 bits, hashes))
+                out.write(bloom)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+    finally:
+        for chunk in chunks:
+            os.unlink(chunk)
+    return written
+
+
+def spill_hashes(batch, directory):
+    batch.sort()
+    fd, name = tempfile.mkstemp(dir=directory, suffix='.chunk')
+    with os.fdopen(fd, 'wb') as f:
+        for value in batch:
+            f.write(REVOCATION_ENTRY.pack(value))
+    return name
+
+
+def read_hashes(name):
+    with open(name, 'rb') as f:
+        while True:
+            data = f.read(REVOCATION_ENTRY.size * 4096)
+            if not data:
+                break
+            for offset in xrange(0, len(data), REVOCATION_ENTRY.size):
+                yield REVOCATION_ENTRY.unpack_from(data, offset)[0]
+
+
+class ReceiptVerifier(local.LocalVerifier):
+
+    def __init__(self, *args, **kwargs):
+        # Almost every receipt is signed by one of a handful of certificates
+        # so there's no sense checking the same chain over and over again.
+        self.chain_cache = LRUCache(kwargs.pop('chain_cache_size', 100))
+        revocations = kwargs.pop('revocations', None)
+        if isinstance(revocations, basestring):
+            revocations = RevocationIndex(revocations)
+        self.revocations = revocations
+        if len(args) < 3:
+            kwargs.setdefault('certs', PublicKeys())
+        super(ReceiptVerifier, self).__init__(*args, **kwargs)
+
+    def parse_jwt(self, data):
+        return parse_jwt(data)
+
+    def verify(self, assertion, audience=None, now=None):
+        """Verify the certificate chain for the receipt
+        """
+        if now is None:
+            now = int(time.time())
+
+        # This catches KeyError and turns it into ValueError.
+        # It saves having to test for the existence of individual
+        # items in the various payloads.
+        try:
+            # Grab the assertion, check that it has not expired.
+            # No point doing all that crypto if we're going to fail out anyway.
+            certificates, assertion = unbundle_certs_and_assertion(assertion)
+            assertion = self.parse_jwt(assertion)
+            if assertion.payload["exp"] < now:
+                raise ExpiredSignatureError(assertion.payload["exp"])
+            if (self.revocations is not None
+                    and self.revocations.is_revoked(assertion.payload)):
+                raise RevokedReceiptError("receipt has been revoked")
+
+            # Verify the entire chain of certificates, unless it's been done
+            # already.
+            cert = self.verified_chain(certificates, now=now)
+
+            # Check the signature on the assertion.
+            if not self.check_token_signature(assertion, cert):
+                raise InvalidSignatureError("invalid signature on assertion")
+        except KeyError:
+            raise ValueError("Malformed JWT")
+        # Looks good!
+        return True
+
+    def verified_chain(self, certificates, now):
+        """Returns the final certificate of a verified chain of certificates.
+
+        The chain is only parsed and verified if it isn't already in the
+        cache.
+        """
+        key = tuple(certificates)
+        cert = self.chain_cache.get(key, now)
+        if cert is None:
+            certificates = [self.parse_jwt(c) for c in certificates]
+            cert = self.verify_certificate_chain(certificates, now=now)
+            expires = min(c.payload["exp"] for c in certificates)
+            self.chain_cache.put(key, cert, expires)
+        return cert
+
+    def check_token_signature(self, data, cert):
+        return data.check_signature(cert.payload["jwk"][0])
+
+    def verify_certificate_chain(self, certificates, now=None):
+        """Verify a signed chain of certificates.
+
+        This function checks the signatures on the given chain of JWT
+        certificates.  It looks up the public key for the issuer of the
+        first certificate, then uses each certificate in turn to check the
+        signature on its successor.
+
+        If the entire chain is valid then to final certificate is returned.
+        """
+        if not certificates:
+            raise ValueError("chain must have at least one certificate")
+        if now is None:
+            now = int(time.time())
+        root_issuer = certificates[0].payload["iss"]
+        root_key = self.certs[root_issuer]
+        current_key = root_key
+        for cert in certificates:
+            if cert.payload["exp"] < now:
+                raise ExpiredSignatureError("expired certificate in chain")
+            if not cert.check_signature(current_key):
+                raise InvalidSignatureError("bad signature in chain by: '%s'" % current_key['kid'])
+            current_key = cert.payload["jwk"][0]
+        return cert
+
+class ConcurrentReceiptVerifier(ReceiptVerifier):
+    """Verifies batches of receipts from many issuers at once.
+
+    The issuer keys a batch needs are fetched concurrently, once per URL and
+    no more than per_host at a time from any one host, and the signatures are
+    then checked on the same thread pool.  A batch with many issuers costs
+    about as much as its slowest fetch rather than the sum of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        workers = kwargs.pop('workers', 10)
+        self.per_host = kwargs.pop('per_host', 2)
+        super(ConcurrentReceiptVerifier, self).__init__(*args, **kwargs)
+        self.pool = ThreadPool(workers)
+        self.host_limits = {}
+        self.host_lock = threading.Lock()
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc
+        with self.host_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return self.host_limits[host]
+
+    def root_issuer(self, assertion):
+        try:
+            certificates, _ = unbundle_certs_and_assertion(assertion)
+            return self.parse_jwt(certificates[0]).payload["iss"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            # Malformed, verifying it will say so
+            return None
+
+    def prefetch(self, url):
+        with self.host_limit(url):
+            try:
+                self.certs[url]
+            except Exception:
+                # Failures are remembered by the fetcher and raised again
+                # when the receipts are verified
+                pass
+
+    def check(self, assertion, now):
+        try:
+            return self.verify(assertion, now=now)
+        except Exception, e:
+            return e
+
+    def verify_many(self, assertions, now=None):
+        """Verify a batch of receipts.
+
+        Returns a list in the same order with True for each valid receipt and
+        the exception raised for each invalid one.
+        """
+        if now is None:
+            now = int(time.time())
+        assertions = list(assertions)
+        urls = set(self.root_issuer(a) for a in assertions)
+        urls.discard(None)
+        self.pool.map(self.prefetch, urls, 1)
+        return self.pool.map(lambda a: self.check(a, now), assertions)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+#
+# Bulk verification.  Receipts are read a window at a time and grouped by
+# certificate chain so each worker checks a chain once and then only the
+# receipt signatures.  Only a bounded number of chunks are ever in flight so
+# memory use doesn't grow with the input.
+#
+
+BULK_VERIFIER = None
+
+
+def init_bulk_worker(certs=None, cache_dir=None, revocations=None):
+    global BULK_VERIFIER, FETCHER
+    if cache_dir:
+        FETCHER = PublicKeyFetcher(cache_dir=cache_dir)
+    BULK_VERIFIER = ReceiptVerifier(certs=certs or PublicKeys(FETCHER),
+                                    revocations=revocations, warning=False)
+
+
+def verify_chunk(chunk, now=None):
+    """Verifies a list of (line number, receipt) pairs in a worker, returning
+    a result dict for each.
+    """
+    results = []
+    for lineno, receipt in chunk:
+        try:
+            BULK_VERIFIER.verify(receipt, now=now)
+            results.append(dict(line=lineno, valid=True))
+        except Exception, e:
+            results.append(dict(line=lineno, valid=False,
+                                error=e.__class__.__name__, reason=str(e)))
+    return results
+
+
+def read_receipts(stream):
+    for lineno, line in enumerate(stream, 1):
+        line = line.strip()
+        if line:
+            yield lineno, line
+
+
+def chain_of(receipt):
+    # Everything before the last ~ is the certificate chain
+    return receipt.rsplit('~', 1)[0]
+
+
+def chunk_receipts(receipts, window=1000, chunk_size=100):
+    """Groups receipts by certificate chain, window receipts at a time, and
+    yields them in chunks of at most chunk_size.
+    """
+    batch = []
+    for item in receipts:
+        batch.append(item)
+        if len(batch) >= window:
+            for chunk in group_by_chain(batch, chunk_size):
+                yield chunk
+            batch = []
+    for chunk in group_by_chain(batch, chunk_size):
+        yield chunk
+
+
+def group_by_chain(batch, chunk_size):
+    groups = OrderedDict()
+    for lineno, receipt in batch:
+        groups.setdefault(chain_of(receipt), []).append((lineno, receipt))
+    for items in groups.itervalues():
+        for i in xrange(0, len(items), chunk_size):
+            yield items[i:i + chunk_size]
+
+
+def verify_bulk(stream, output, processes=None, window=1000, chunk_size=100,
+                pending=None, now=None, certs=None, cache_dir=None,
+                revocations=None):
+    """Verifies the receipts in stream, one per line, and writes a JSON result
+    per line to output.  Results carry the line number of their receipt and
+    come out grouped by chain within each window rather than in input order.
+
+    Returns a dict of counts of valid and invalid receipts.
+    """
+    pool = multiprocessing.Pool(processes, init_bulk_worker,
+                                (certs, cache_dir, revocations))
+    if pending is None:
+        pending = 4 * (processes or multiprocessing.cpu_count())
+    inflight = deque()
+    counts = dict(valid=0, invalid=0)
+
+    def drain(limit):
+        while len(inflight) > limit:
+            for result in inflight.popleft().get():
+                counts['valid' if result['valid'] else 'invalid'] += 1
+                output.write(json.dumps(result) + '\n')
+
+    try:
+        for chunk in chunk_receipts(read_receipts(stream), window,
+                                    chunk_size):
+            inflight.append(pool.apply_async(verify_chunk, (chunk, now)))
+            drain(pending)
+        drain(0)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+
+def bulk_main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Verify receipts in bulk, one per line, writing a JSON "
+                    "result for each")
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of receipts, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file to write results to, - for stdout '
+                             '(default)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'core)')
+    parser.add_argument('--window', type=int, default=1000,
+                        help='receipts grouped by chain at a time')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='receipts handed to a worker at a time')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to share fetched issuer keys through')
+    parser.add_argument('--now', type=int, default=None,
+                        help='verify as of this UNIX timestamp')
+    parser.add_argument('--revocations', default=None,
+                        help='revocation index to reject revoked receipts '
+                             'with')
+    args = parser.parse_args(argv)
+
+    stream = sys.stdin if args.input == '-' else open(args.input, 'r')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        counts = verify_bulk(stream, output, processes=args.processes,
+                             window=args.window, chunk_size=args.chunk_size,
+                             now=args.now, cache_dir=args.cache_dir,
+                             revocations=args.revocations)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write("%(valid)d valid, %(invalid)d invalid\n" % counts)
+    return 1 if counts['invalid'] else 0
+
+
+def read_revocations(stream):
+    # One revoked receipt per line, either its jti or its issuer and
+    # storedata separated by a tab
+    for line in stream:
+        line = line.rstrip('\r\n').decode('utf-8')
+        if not line:
+            continue
+        if '\t' in line:
+            iss, storedata = line.split('\t', 1)
+            yield revocation_key(iss=iss, storedata=storedata)
+        else:
+            yield revocation_key(jti=line)
+
+
+def revocations_main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build a revocation index for ReceiptVerifier from a "
+                    "list of revoked receipts, one jti or tab separated "
+                    "issuer and storedata per line")
+    parser.add_argument('output', help='index file to write')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of revoked receipts, - for stdin '
+                             '(default)')
+    parser.add_argument('--error-rate', type=float, default=0.001,
+                        help='Bloom filter false positive rate')
+    args = parser.parse_args(argv)
+
+    stream = sys.stdin if args.input == '-' else open(args.input, 'r')
+    try:
+        count = build_revocation_index(read_revocations(stream), args.output,
+                                       error_rate=args.error_rate)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    sys.stderr.write("%d revoked receipts indexed\n" % count)
+    return 0
+
+
+#
+# MONKEY PATCH TIME!
+#
+browserid.certificates.fetch_public_key_orig = browserid.certificates.fetch_public_key
+browserid.certificates.fetch_public_key = fetch_public_key
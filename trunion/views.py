@@ -6,12 +6,53 @@
 """ Cornice services.
 """
 from base64 import b64encode
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import os
 import os.path
+import tempfile
+import threading
+import time
+import uuid
 
 from cornice import Service
 import crypto
-from pyramid.httpexceptions import HTTPUnsupportedMediaType
-from validators import valid_addon, valid_app, valid_receipt
+from jar import file_chunks
+import logqueue
+from pyramid.httpexceptions import HTTPException, HTTPUnsupportedMediaType
+from pyramid.response import Response
+from validators import (check_addon_item, check_receipt, valid_addon,
+                        valid_addon_batch, valid_app, valid_archive,
+                        valid_receipt, valid_receipt_batch, valid_verify)
+import verifier
+
+
+# Signatures are returned base64 encoded in JSON unless the client would
+# rather have the DER as is
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+MULTIPART_CONTENT_TYPE = 'multipart/mixed'
+PKCS7_CONTENT_TYPE = 'application/pkcs7-signature'
+ZIP_CONTENT_TYPE = 'application/zip'
+
+
+def wants_der(request):
+    accept = getattr(request, 'accept', None)
+    if accept is None:
+        return False
+    return (accept.best_match([JSON_CONTENT_TYPE, PKCS7_CONTENT_TYPE])
+            == PKCS7_CONTENT_TYPE)
+
+
+def signature_response(request, fname, pkcs7):
+    if wants_der(request):
+        response = Response(body=pkcs7, content_type=PKCS7_CONTENT_TYPE)
+        response.content_disposition = ('attachment; filename="%s.rsa"'
+                                        % fname)
+        return response
+    return {fname + '.rsa': b64encode(pkcs7)}
 
 
 status = Service(name='status', path='/status', description='Status')
@@ -19,7 +60,18 @@ status = Service(name='status', path='/status', description='Status')
 
 @status.get()
 def status(request):
-    return {'status': 'true'}
+    result = {'status': 'true'}
+    log_queues = logqueue.stats()
+    if log_queues is not None:
+        result['log_queues'] = log_queues
+    sign_cache = crypto.sign_cache_stats()
+    if sign_cache is not None:
+        result['sign_cache'] = sign_cache
+    if request.registry.settings.get('trunion.we_are_signing') == 'addons':
+        pool = crypto.ephemeral_pool_stats()
+        if pool is not None:
+            result['ephemeral_pool'] = pool
+    return result
 
 
 sign = Service(name='sign', path='/1.0/sign', description="Receipt signer")
@@ -32,15 +84,63 @@ def sign_receipt(request):
 
     # Part one of the certified receipt is
     # our ephemeral key's certificate
-    result = [crypto.get_certificate()]
-
+    #
     # Part two of the certified_receipt is the
     # input receipt, signed with our software key.
+    #
+    # Retries of a recently signed receipt come back from the signing cache,
+    # if it's enabled, rather than being signed again.
+    return {'receipt': crypto.sign_receipt(receipt)}
+
+
+signbatch = Service(name='sign_batch', path='/1.0/sign_batch',
+                    description="Batch receipt signer")
+
 
-    # Sign the receipt with our current ephemeral key
-    result.append(crypto.sign_jwt(receipt))
+@signbatch.post(validators=valid_receipt_batch)
+def sign_receipt_batch(request):
+    # The validator only looked at the envelope, so each receipt is checked
+    # here and failures are reported in place rather than failing the batch.
+    now = long(time.time())
 
-    return {'receipt': '~'.join(result)}
+    results = []
+    for index, receipt in enumerate(request.json_body):
+        try:
+            check_receipt(receipt, now)
+            results.append({'status': 'ok',
+                            'receipt': crypto.sign_receipt(receipt)})
+        except HTTPException, e:
+            results.append({'status': 'error', 'code': e.code,
+                            'error': e.detail})
+        except Exception:
+            logging.error("Failed to sign receipt %d of a batch" % index,
+                          exc_info=True)
+            results.append({'status': 'error', 'code': 500,
+                            'error': 'signing failed'})
+
+    return {'receipts': results}
+
+
+verify = Service(name='verify', path='/1.0/verify',
+                 description="Receipt verifier")
+
+
+@verify.post(validators=valid_verify)
+def verify_receipt(request):
+    # A single receipt gets a single result, a list of them a list of results
+    # in the same order.
+    now = long(time.time())
+
+    def check(receipt):
+        try:
+            return {'status': 'ok',
+                    'receipt': verifier.verify(receipt, now)}
+        except verifier.VerificationError, e:
+            return {'status': 'invalid', 'reason': str(e)}
+
+    if isinstance(request.json_body, basestring):
+        return check(request.json_body)
+    return {'receipts': [check(receipt) for receipt in request.json_body]}
 
 
 signapp = Service(name='sign_app', path='/1.0/sign_app',
@@ -52,9 +152,10 @@ def sign_app(request):
     if request.registry.settings['trunion.we_are_signing'] != 'apps':
         raise HTTPUnsupportedMediaType()
 
-    fname = os.path.splitext(request.POST['file'].filename)[0]
-    pkcs7 = crypto.sign_app(request.POST['file'].file.read())
-    return {fname + '.rsa': b64encode(pkcs7)}
+    # valid_app read the upload, from a form or the raw body
+    fname = os.path.splitext(request.validated['filename'])[0]
+    pkcs7 = crypto.sign_app(request.validated['signature'])
+    return signature_response(request, fname, pkcs7)
 
 
 signaddon = Service(name='sign_addon', path='/1.0/sign_addon',
@@ -66,9 +167,146 @@ def sign_addon(request):
     if request.registry.settings['trunion.we_are_signing'] != 'addons':
         raise HTTPUnsupportedMediaType()
 
-    pkcs7 = crypto.sign_addon(request.POST['addon_id'],
-                              request.POST['file'].file.read())
+    # valid_addon already read and parsed the upload, from a form or the raw
+    # body
+    pkcs7 = crypto.sign_addon(request.validated['addon_id'],
+                              request.validated['signature'])
 
-    fname = os.path.splitext(request.POST['file'].filename)[0]
+    fname = os.path.splitext(request.validated['filename'])[0]
 
-    return {fname + '.rsa': b64encode(pkcs7)}
+    return signature_response(request, fname, pkcs7)
+
+
+signaddonbatch = Service(name='sign_addon_batch', path='/1.0/sign_addon_batch',
+                         description="Batch addon signer")
+
+# Add-on batches are signed on a pool of threads, per process, but the keys
+# are generated by the ephemeral factory's worker processes, one per core
+# unless ephemeral_keygen_processes says otherwise.  M2Crypto keeps the GIL
+# while OpenSSL works so the threads are only left with what has to happen
+# here, certifying the key and signing with it, and wait on the workers with
+# the GIL released.  Those steps stay on threads as a key held by an HSM
+# engine can't safely be shared with forked children.
+BATCH_POOL = None
+BATCH_POOL_LOCK = threading.Lock()
+
+
+def batch_pool(settings):
+    global BATCH_POOL
+    with BATCH_POOL_LOCK:
+        if BATCH_POOL is None or BATCH_POOL[0] != os.getpid():
+            workers = (int(settings.get('addons.batch_workers', 0))
+                       or multiprocessing.cpu_count())
+            BATCH_POOL = (os.getpid(), ThreadPool(workers))
+        return BATCH_POOL[1]
+
+
+def sign_addon_item(task):
+    index, item = task
+    try:
+        addon_id, filename, data = check_addon_item(item)
+        pkcs7 = crypto.sign_addon(addon_id, data, crypto.batch_addon_key())
+    except HTTPException, e:
+        return {'index': index, 'status': 'error', 'code': e.code,
+                'error': e.detail}, None
+    except Exception:
+        logging.error("Failed to sign item %d of an add-on batch" % index,
+                      exc_info=True)
+        return {'index': index, 'status': 'error', 'code': 500,
+                'error': 'signing failed'}, None
+    fname = os.path.splitext(filename)[0]
+    return {'index': index, 'status': 'ok', 'addon_id': addon_id,
+            'filename': fname + '.rsa'}, pkcs7
+
+
+def ndjson_results(results):
+    for result, pkcs7 in results:
+        if pkcs7 is not None:
+            result['signature'] = b64encode(pkcs7)
+        yield json.dumps(result) + '\n'
+
+
+def multipart_results(results, boundary):
+    for result, pkcs7 in results:
+        headers = ['--' + boundary, 'X-Batch-Index: %d' % result['index']]
+        if pkcs7 is None:
+            headers.append('Content-Type: ' + JSON_CONTENT_TYPE)
+            body = json.dumps(result)
+        else:
+            headers.append('Content-Type: ' + PKCS7_CONTENT_TYPE)
+            headers.append('Content-Disposition: attachment; filename="%s"'
+                           % result['filename'])
+            body = pkcs7
+        yield '\r\n'.join(headers) + '\r\n\r\n' + body + '\r\n'
+    yield '--' + boundary + '--\r\n'
+
+
+@signaddonbatch.post(validators=valid_addon_batch)
+def sign_addon_batch(request):
+    """
+    Each result is sent as soon as its item is signed so they arrive in
+    whatever order they finish, tagged with the item's index.  Results are
+    NDJSON, base64 encoding signatures as sign_addon does, unless the client
+    prefers multipart/mixed in which case signatures are sent as DER parts.
+    """
+    if request.registry.settings['trunion.we_are_signing'] != 'addons':
+        raise HTTPUnsupportedMediaType()
+
+    pool = batch_pool(request.registry.settings)
+    results = pool.imap_unordered(sign_addon_item,
+                                  enumerate(request.json_body))
+
+    accept = getattr(request, 'accept', None)
+    if accept is not None and accept.best_match(
+            [NDJSON_CONTENT_TYPE, JSON_CONTENT_TYPE,
+             MULTIPART_CONTENT_TYPE]) == MULTIPART_CONTENT_TYPE:
+        boundary = uuid.uuid4().hex
+        response = Response(app_iter=multipart_results(results, boundary))
+        response.content_type = MULTIPART_CONTENT_TYPE
+        response.content_type_params = {'boundary': boundary}
+        return response
+
+    response = Response(app_iter=ndjson_results(results))
+    response.content_type = NDJSON_CONTENT_TYPE
+    return response
+
+
+signarchive = Service(name='sign_archive', path='/1.0/sign_archive',
+                      description="Whole app or add-on archive signer")
+
+
+@signarchive.post(validators=valid_archive)
+def sign_archive(request):
+    """
+    Builds the manifest and signature file for an unsigned archive, signs it
+    as sign_app or sign_addon would, whichever valid_archive found this is,
+    and sends back the signed archive.  Both archives are kept on disk rather
+    than in memory.
+    """
+    spool = request.validated['spool']
+    try:
+        archive = request.validated['archive']
+        signature = str(archive.signatures)
+        if request.registry.settings['trunion.we_are_signing'] == 'addons':
+            pkcs7 = crypto.sign_addon(request.validated['addon_id'],
+                                      signature)
+        else:
+            pkcs7 = crypto.sign_app(signature)
+
+        signed = tempfile.NamedTemporaryFile(prefix='trunion-',
+                                             suffix='.zip')
+        try:
+            archive.make_signed(pkcs7, signed)
+            signed.seek(0)
+        except:
+            signed.close()
+            raise
+    finally:
+        spool.close()
+
+    response = Response(app_iter=file_chunks(signed),
+                        content_type=ZIP_CONTENT_TYPE)
+    response.content_length = os.fstat(signed.fileno()).st_size
+    response.content_disposition = ('attachment; filename="%s"'
+                                    % request.validated['filename'])
+    return response